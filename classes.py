@@ -1,13 +1,107 @@
+import multiprocessing
+import os
 import pickle
+import queue
+import sqlite3
+import struct
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait
+from contextlib import contextmanager
 from hashlib import sha256
-from ecdsa import SigningKey, VerifyingKey
+from ecdsa import BadSignatureError, SECP256k1, SigningKey, VerifyingKey
+from ecdsa.errors import MalformedPointError
 import KeysGeneration
 
+# Seperator between the fields of a locking script
+SEPERATOR = "<SEPERATOR>".encode()
+
+
+# Model Class that the classes stored in the database or sent to the other nodes inherit from
+# Their attributes are declared in __slots__ so their instances have no __dict__, and the way they are
+# stored in the database is described once for the whole class by its schema
+class Model:
+    __slots__ = ()
+    # Values of the attributes missing from the objects pickled by older versions
+    defaults = {}
+
+    # Function that returns the names of the attributes of the object, the ones of its parent classes first
+    @classmethod
+    def slotNames(cls):
+        names = []
+        for klass in reversed(cls.__mro__):
+            names.extend(klass.__dict__.get("__slots__", ()))
+        return names
+
+    # Function that returns the pickled state of the object
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.slotNames()}
+
+    # Function that restores the object from its pickled state
+    # The states pickled by older versions also hold the objectDesc of the object, it's ignored
+    def __setstate__(self, state):
+        if isinstance(state, tuple):
+            state = dict(state[0] or {}, **state[1])
+        for name in self.slotNames():
+            setattr(self, name, state.get(name, self.defaults.get(name)))
+
+
+# Schema Class that describes how the instances of a class are stored in the database: their table, its columns
+# named after the attributes holding their values, the attribute that identifies a row and the attributes encoded
+# with the Codec
+# The values of a row are only produced when the object is written
+class Schema:
+    # Classes stored in the database by table name
+    registry = {}
+
+    def __init__(self, tableName, columns, distinctAttrib, encodedAttribs):
+        self.tableName = tableName
+        self.columns = columns
+        self.columnNames = "({})".format(", ".join(":" + column for column in columns))
+        self.distinctAttrib = distinctAttrib
+        self.encodedAttribs = encodedAttribs
+
+    # Function that gives the designed class its schema and registers it as the class of the table
+    @staticmethod
+    def register(cls, tableName, columns, distinctAttrib, encodedAttribs):
+        cls.schema = Schema(tableName, columns, distinctAttrib, encodedAttribs)
+        Schema.registry[tableName] = cls
+
+    # Function that returns the values of the columns of the designed object
+    def values(self, object):
+        return {column: getattr(object, column) for column in self.columns}
+
+    # Function that returns the values of the row of the designed object, with its encoded attributes encoded
+    # Raw rows received from the server already hold encoded attributes
+    def rowValues(self, object):
+        values = self.values(object)
+        for attrib in self.encodedAttribs:
+            if not isinstance(values[attrib], bytes):
+                values[attrib] = Codec.encode(values[attrib])
+        return values
+
+
+# ObjectDesc Class that older versions stored as an attribute in every object
+# It's only kept so that the objects they pickled can still be unpickled, their objectDesc is then ignored
+class ObjectDesc:
+    def __init__(self, databaseTableName, databaseColumnNames, databaseValues, distinctAttrib, toPickleAttrib):
+        self.databaseTableName = databaseTableName
+        self.databaseColumnNames = databaseColumnNames
+        self.databaseValues = databaseValues
+        self.distinctAttrib = distinctAttrib
+        self.toPickleAttrib = toPickleAttrib
+
 
 # Block Class with it's basic attributes
-class Block:
-    def __init__(self, index, transactions, timestamp, previousHash, blockHash, reward, nonce, difficulty):
+class Block(Model):
+    __slots__ = ("id", "transactions", "timestamp", "previousHash", "hash", "reward", "nonce", "difficulty",
+                 "merkleRoot")
+    # Blocks stored by older versions have no Merkle root, it's computed again when they are read
+    defaults = {"merkleRoot": ""}
+
+    def __init__(self, index, transactions, timestamp, previousHash, blockHash, reward, nonce, difficulty,
+                 merkleRoot=""):
         self.id = index
         self.transactions = transactions
         self.timestamp = timestamp
@@ -16,29 +110,84 @@ class Block:
         self.reward = reward
         self.nonce = nonce
         self.difficulty = difficulty
-        self.objectDesc = ObjectDesc("Blocks",
-                                     "(:id, :transactions, :timestamp, :previousHash, :hash, :reward, :nonce, :difficulty)",
-                                     {}, "id", ["transactions"])
-        self.objectDesc.setDatabaseValues(self.__dict__)
+        # Root of the Merkle tree built over the transactions ids, it is the header's commitment to the transactions
+        self.merkleRoot = merkleRoot
 
-    def computeHash(self):
-        # self.__dict__ => all attributes defined for the object Block
-        blockString = pickle.dumps(self.__dict__)
+    # Function that calculates the hash of the block's header with the designed nonce (the block's nonce by default)
+    def computeHash(self, nonce=None):
+        if nonce is None:
+            nonce = self.nonce
+        blockHash = self.headerMidstate()
+        blockHash.update(nonceFormat.pack(nonce))
 
-        # sha256() => Hash it with sha256
         # hexdigest() => Returns the encoded data in hexadecimal format
-        return (sha256(blockString)).hexdigest()
-
-    # Function that mines the block by calling the computeHash function until it the resulting hash satisfies the block's difficulty
-    def mine(self, wallet):
-        self.transactions.append(wallet.constructCoinbaseTx(50, wallet.address, None))
-        blockHash = self.computeHash()
-        while not blockHash.startswith('0' * self.difficulty):
-            self.nonce += 1
-            blockHash = self.computeHash()
-        self.hash = blockHash
-        self.objectDesc.setDatabaseValues(self.__dict__)
-        return blockHash
+        return blockHash.hexdigest()
+
+    # Function that builds the Merkle tree of the block's transactions
+    def merkleTree(self):
+        return MerkleTree([tx.transactionId for tx in self.transactions])
+
+    # Function that computes and sets the block's Merkle root
+    def updateMerkleRoot(self):
+        self.merkleRoot = self.merkleTree().root()
+        return self.merkleRoot
+
+    # Function that checks that the block's Merkle root commits to its transactions
+    def verifyMerkleRoot(self):
+        return self.merkleRoot == self.merkleTree().root()
+
+    # Function that checks that the block's Merkle root and hash are valid and that the hash satisfies the difficulty
+    def verify(self):
+        return self.verifyMerkleRoot() and self.hash == self.computeHash() and self.hash.startswith(
+            '0' * self.difficulty)
+
+    # Function that returns the proof that the designed transaction is in the block, None if it isn't
+    def merkleProof(self, transactionId):
+        txIds = [tx.transactionId for tx in self.transactions]
+        if transactionId not in txIds:
+            return None
+        return self.merkleTree().proof(txIds.index(transactionId))
+
+    # Function that returns the constant part of the header: previous hash, Merkle root, timestamp
+    # and difficulty packed in a fixed byte layout, the nonce is appended to it to obtain the full header
+    def headerPrefix(self):
+        return headerPrefixFormat.pack(hashToBytes(self.previousHash), hashToBytes(self.merkleRoot),
+                                       float(self.timestamp), self.difficulty)
+
+    # Function that returns the sha256 state after hashing the header's prefix
+    # Copying this state then feeding it the nonce's bytes gives the hash without rehashing the whole header
+    def headerMidstate(self):
+        return sha256(self.headerPrefix())
+
+    # Function that returns the full binary header of the block
+    def header(self):
+        return self.headerPrefix() + nonceFormat.pack(self.nonce)
+
+    # Function that mines the block by searching for a nonce whose hash satisfies the block's difficulty
+    # The nonce space is split across the processes of the Miner, workers=None uses all the cores
+    def mine(self, wallet, workers=None):
+        self.addCoinbase(wallet)
+        miner = Miner(workers)
+        try:
+            self.nonce, self.hash = miner.search(self, self.nonce)
+        finally:
+            miner.close()
+        return self.hash
+
+    # Function that only searches the nonces in [start, end[ with the designed Miner, it's used in pool mode
+    # Returns the hash if one of these nonces satisfies the block's difficulty, None otherwise
+    def mineRange(self, start, end, miner):
+        result = miner.search(self, start, end)
+        if result is None:
+            return None
+        self.nonce, self.hash = result
+        return self.hash
+
+    # Function that adds the transaction rewarding the miner to the block then updates the Merkle root
+    # It pays the block's reward: the 50 coins of the block and the fees of its transactions
+    def addCoinbase(self, wallet):
+        self.transactions.append(wallet.constructCoinbaseTx(self.reward, wallet.address, None))
+        self.updateMerkleRoot()
 
     # Function that calculates the block's reward
     def finalReward(self):
@@ -46,8 +195,286 @@ class Block:
             self.reward += tx.fees
 
 
+# Fixed byte layout of the block header (little-endian): previous hash (32 bytes), Merkle root (32 bytes),
+# timestamp (double) and difficulty (unsigned int), followed by the nonce (unsigned long long)
+headerPrefixFormat = struct.Struct("<32s32sdI")
+nonceFormat = struct.Struct("<Q")
+
+
+# Function that converts a hexadecimal hash to its 32 bytes, an empty hash (genesis block) gives 32 null bytes
+def hashToBytes(hexHash):
+    if not hexHash:
+        return bytes(32)
+    return bytes.fromhex(hexHash)
+
+
+# MerkleTree Class built over a list of transactions ids
+# The root commits to all the transactions and a log-sized proof shows that a transaction is part of the tree
+class MerkleTree:
+    def __init__(self, transactionIds):
+        # levels[0] holds the leaves (the transactions ids) and levels[-1] holds the root
+        self.levels = [[hashToBytes(txId) for txId in transactionIds]]
+        while len(self.levels[-1]) > 1:
+            level = self.levels[-1]
+            # A level with an odd number of nodes pairs its last node with itself
+            if len(level) % 2:
+                level = level + [level[-1]]
+            self.levels.append([sha256(level[i] + level[i + 1]).digest() for i in range(0, len(level), 2)])
+
+    # Function that returns the root of the tree in hexadecimal format, an empty tree has a null root
+    def root(self):
+        if not self.levels[0]:
+            return bytes(32).hex()
+        return self.levels[-1][0].hex()
+
+    # Function that returns the proof of the leaf at the designed index
+    # The proof is the list of (sibling hash, True if the sibling is on the left) from the leaf up to the root
+    def proof(self, index):
+        proof = []
+        for level in self.levels[:-1]:
+            siblingIndex = index ^ 1
+            if siblingIndex >= len(level):
+                siblingIndex = index
+            proof.append((level[siblingIndex].hex(), siblingIndex < index))
+            index //= 2
+        return proof
+
+    # Function that checks that the proof links the designed transaction id to the root
+    @staticmethod
+    def verifyProof(transactionId, proof, root):
+        node = hashToBytes(transactionId)
+        for sibling, isLeft in proof:
+            if isLeft:
+                node = sha256(hashToBytes(sibling) + node).digest()
+            else:
+                node = sha256(node + hashToBytes(sibling)).digest()
+        return node.hex() == root
+
+
+# Number of nonces a mining process tries before checking if another process already found the block's hash
+nonceCheckInterval = 1000
+
+# Event shared by all the mining processes of a pool, it is set as soon as one of them finds a valid hash
+miningStopEvent = None
+
+
+# Function that initializes every mining process with the pool's stop event
+def initMiningProcess(stopEvent):
+    global miningStopEvent
+    miningStopEvent = stopEvent
+
+
+# Function executed by every mining process
+# It tries the nonces start, start + step, start + 2 * step... until it finds a valid hash, reaches end or is stopped
+def mineNonces(block, start, step, end):
+    target = '0' * block.difficulty
+    # The header's prefix is hashed once, every try only feeds the nonce's bytes to a copy of this state
+    midstate = block.headerMidstate()
+    packNonce = nonceFormat.pack
+    nonce = start
+    tries = 0
+    while end is None or nonce < end:
+        attempt = midstate.copy()
+        attempt.update(packNonce(nonce))
+        blockHash = attempt.hexdigest()
+        if blockHash.startswith(target):
+            miningStopEvent.set()
+            return nonce, blockHash
+        nonce += step
+        tries += 1
+        if tries % nonceCheckInterval == 0 and miningStopEvent.is_set():
+            return None
+    return None
+
+
+# Miner Class that splits the nonce space of a block across a pool of processes
+class Miner:
+    def __init__(self, workers=None):
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self.workers = workers
+        self.stopEvent = multiprocessing.Event()
+        # The pool of processes is started by the first search and reused by the next ones until close() is called
+        self.pool = None
+
+    # Function that returns the (nonce, hash) pair of the first valid hash found in [start, end[
+    # Every process gets its own share of the nonces and all of them stop once one finds a valid hash
+    # Returns None if the range is exhausted or if the search was stopped from the outside
+    def search(self, block, start=0, end=None):
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(self.workers, initializer=initMiningProcess, initargs=(self.stopEvent,))
+        self.stopEvent.clear()
+        result = None
+        futures = [self.pool.submit(mineNonces, block, start + i, self.workers, end) for i in range(self.workers)]
+        for future in as_completed(futures):
+            if future.result() is not None:
+                result = future.result()
+                break
+        self.stopEvent.set()
+        # Waiting for every process to stop before the pool can be reused
+        wait(futures)
+        return result
+
+    # Function that stops a search running in another thread
+    def stop(self):
+        self.stopEvent.set()
+
+    # Function that shuts the pool of processes down
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+
+# Function that checks that the scriptSig is the signature of the locking script by the pubkey it starts with
+def verifySignature(lockingScript, scriptSig):
+    try:
+        pubkey = VerifyingKey.from_string(lockingScript.split(SEPERATOR)[0], curve=SECP256k1)
+        return pubkey.verify(scriptSig, lockingScript)
+    except (BadSignatureError, MalformedPointError):
+        return False
+
+
+# Function that sets the locking script of the output, it can only be spent by a signature of the designed pubkey
+def createLockingScript(pubkey, out):
+    outScript = pubkey + SEPERATOR + str(out.value).encode() + SEPERATOR + out.address.encode() + SEPERATOR + str(
+        out.transactionId).encode() + SEPERATOR + str(time.time()).encode()
+    out.lockingScript = outScript
+    return out
+
+
+# Function executed by the processes of the SignatureVerifier on a chunk of (lockingScript, scriptSig) pairs
+def verifySignatures(pairs):
+    return [verifySignature(lockingScript, scriptSig) for lockingScript, scriptSig in pairs]
+
+
+# SignatureCache Class that remembers the signatures that were already found valid
+# It is a bounded LRU: once full, the signature that was used the longest time ago is forgotten
+class SignatureCache:
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # Function that returns the cache key of a signature: the hash of the pubkey, scriptSig and locking script hashes
+    @staticmethod
+    def key(lockingScript, scriptSig):
+        pubkey = lockingScript.split(SEPERATOR)[0]
+        return sha256(sha256(pubkey).digest() + sha256(scriptSig).digest() + sha256(lockingScript).digest()).digest()
+
+    # Function that checks if the signature was already found valid
+    def contains(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    # Function that remembers a valid signature
+    def add(self, key):
+        self.entries[key] = True
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
+
+
+# SignatureVerifier Class that checks the signatures of many inputs in parallel on a pool of processes
+# Signatures found in the cache are not checked again and the valid ones are added to it
+class SignatureVerifier:
+    def __init__(self, workers=None, cache=None):
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self.workers = workers
+        self.cache = cache
+        # The pool of processes is started by the first verification that is worth running in parallel
+        self.pool = None
+
+    # Function that returns the result of the signature check of every input, in the same order
+    def verify(self, inputs):
+        if self.cache is None:
+            return self.check([(input.lockingScript, input.scriptSig) for input in inputs])
+        results = [True] * len(inputs)
+        keys = [self.cache.key(input.lockingScript, input.scriptSig) for input in inputs]
+        misses = [i for i in range(len(inputs)) if not self.cache.contains(keys[i])]
+        checked = self.check([(inputs[i].lockingScript, inputs[i].scriptSig) for i in misses])
+        for i, valid in zip(misses, checked):
+            results[i] = valid
+            if valid:
+                self.cache.add(keys[i])
+        return results
+
+    # Function that checks the designed (lockingScript, scriptSig) pairs
+    def check(self, pairs):
+        # A single signature is checked right away, sending it to another process would cost more than it saves
+        if len(pairs) < 2 or self.workers < 2:
+            return verifySignatures(pairs)
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(self.workers)
+        chunkSize = -(-len(pairs) // self.workers)
+        chunks = [pairs[i:i + chunkSize] for i in range(0, len(pairs), chunkSize)]
+        results = []
+        for chunk in self.pool.map(verifySignatures, chunks):
+            results.extend(chunk)
+        return results
+
+    # Function that returns the results of the signature checks of every input of every transaction
+    # All the inputs of the batch are checked together, the results are grouped by transaction
+    def verifyBatch(self, transactions):
+        results = self.verify([input for tx in transactions for input in tx.inputs])
+        grouped = []
+        for tx in transactions:
+            grouped.append(results[:len(tx.inputs)])
+            results = results[len(tx.inputs):]
+        return grouped
+
+    # Function that shuts the pool of processes down
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+
+# Function that returns the outpoint of the output locked by the designed script in the designed transaction
+# The locking script of an output is unique so its hash identifies the output within the transaction
+def outpoint(transactionId, lockingScript):
+    return transactionId, sha256(lockingScript).digest()
+
+
+# Byte layout of the index of an output in its transaction
+outputIndexFormat = struct.Struct("<I")
+
+
+# Function that returns the compact outpoint of the designed output of the designed transaction:
+# the 32 bytes of the transaction id followed by the index of the output
+def compactOutpoint(transactionId, index):
+    return bytes.fromhex(transactionId) + outputIndexFormat.pack(index)
+
+
+# Fixed byte layouts used by the canonical encoding of a transaction: type, timestamp and number of inputs,
+# value of an input and length of a field
+txIdHeaderFormat = struct.Struct("<BdI")
+inputValueFormat = struct.Struct("<d")
+fieldLengthFormat = struct.Struct("<I")
+
+
+# Function that feeds a length prefixed field to the hasher
+def hashField(hasher, field):
+    if field is None:
+        field = b""
+    elif isinstance(field, str):
+        field = field.encode()
+    elif not isinstance(field, bytes):
+        field = str(field).encode()
+    hasher.update(fieldLengthFormat.pack(len(field)))
+    hasher.update(field)
+
+
 # Input Class that is stored in the inputs attribute of the Transaction class
-class Input:
+class Input(Model):
+    __slots__ = ("value", "address", "prevTxId", "lockingScript", "scriptSig")
+
     def __init__(self, value, address, prevTxId, lockingScript, scriptSig):
         self.value = value
         self.address = address
@@ -57,21 +484,22 @@ class Input:
 
 
 # Output Class that is stored in the outputs attribute of the Transaction class
-class Output:
+class Output(Model):
+    __slots__ = ("id", "value", "address", "transactionId", "lockingScript")
+
     def __init__(self, index, value, address, transactionId, lockingScript):
         self.id = index
         self.value = value
         self.address = address
         self.transactionId = transactionId
         self.lockingScript = lockingScript
-        self.objectDesc = ObjectDesc("UTXO", "(:id, :value, :address, :transactionId, :lockingScript)",
-                                     {}, "lockingScript", [])
-        self.objectDesc.setDatabaseValues(self.__dict__)
 
 
 # Transaction Class that is stored in the transactions attribute of the Block class
-class Transaction:
-    def __init__(self, index=None, type=None, inputs=None, outputs=None, timestamp=time.time(), transactionId="",
+class Transaction(Model):
+    __slots__ = ("id", "type", "inputs", "outputs", "timestamp", "transactionId", "fees", "cachedTxId")
+
+    def __init__(self, index=None, type=None, inputs=None, outputs=None, timestamp=None, transactionId="",
                  fees=None):
         self.id = index
         self.type = type
@@ -79,69 +507,230 @@ class Transaction:
             inputs = []
         if outputs is None:
             outputs = []
+        # The timestamp is taken when the transaction is created, not when the module is imported
+        # otherwise all the coinbase transactions of a node would get the same id
+        if timestamp is None:
+            timestamp = time.time()
         self.inputs = inputs
         self.outputs = outputs
         self.timestamp = timestamp
         self.transactionId = transactionId
         self.fees = fees
-        self.objectDesc = ObjectDesc("Transactions",
-                                     "(:id, :type, :inputs, :outputs, :timestamp, :transactionId, :fees)",
-                                     {}, "transactionId", ["inputs", "outputs"])
-        self.objectDesc.setDatabaseValues(self.__dict__)
+        # Last id computed by computeTxId, None when it has to be computed again
+        self.cachedTxId = None
 
-    # Function that computes and sets the transaction's id
+    # The cached id is not sent with the transaction, the receiver computes it again
+    def __getstate__(self):
+        state = super().__getstate__()
+        state["cachedTxId"] = None
+        return state
+
+    # A cached id found in a received state is dropped, it's never trusted
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self.cachedTxId = None
+
+    # Function that computes and sets the transaction's id, it's only computed again after an input/output was added
     def computeTxId(self):
-        txId = ""
-        for input in self.inputs:
-            d = input.__dict__
-            for attrib in d:
-                txId += sha256(str(d[attrib]).encode()).hexdigest()
-        txId += sha256(str(self.timestamp).encode()).hexdigest()
-        self.transactionId = (sha256(txId.encode())).hexdigest()
-        self.objectDesc.setDatabaseValues(self.__dict__)
+        if self.cachedTxId is None:
+            self.cachedTxId = self.hashTxId()
+        self.transactionId = self.cachedTxId
         return self.transactionId
 
+    # Function that hashes the canonical binary encoding of the transaction with a single streaming hasher:
+    # type, timestamp and number of inputs then the value and the length prefixed fields of every input
+    # The outputs are not part of the id since they hold it
+    def hashTxId(self):
+        hasher = sha256()
+        hasher.update(txIdHeaderFormat.pack(self.type or 0, float(self.timestamp), len(self.inputs)))
+        for input in self.inputs:
+            hasher.update(inputValueFormat.pack(float(input.value)))
+            hashField(hasher, input.address)
+            hashField(hasher, input.prevTxId)
+            hashField(hasher, input.lockingScript)
+            hashField(hasher, input.scriptSig)
+        return hasher.hexdigest()
+
     # Function that adds an input to the tx
     def addInput(self, input):
         self.inputs.append(input)
-        self.objectDesc.setDatabaseValues(self.__dict__)
+        self.cachedTxId = None
 
     # Function that adds an output to the tx
     def addOutput(self, output):
         self.outputs.append(output)
-        self.objectDesc.setDatabaseValues(self.__dict__)
+        self.cachedTxId = None
 
     # Function that calculates the tx fees
     def calculateFees(self):
-        self.fees = 0
-        for input in self.inputs:
-            self.fees += input.value * 0.01
-        self.objectDesc.setDatabaseValues(self.__dict__)
+        self.fees = Transaction.feesFor(input.value for input in self.inputs)
+
+    # Function that returns the fees of a transaction spending the designed values
+    @staticmethod
+    def feesFor(values):
+        fees = 0
+        for value in values:
+            fees += value * 0.01
+        return fees
 
 
 # UnconfirmedTransaction class that inherits from the Transaction class
 class UnconfirmedTransaction(Transaction):
-    def __init__(self, index=None, type=None, inputs=None, outputs=None, timestamp=time.time(), transactionId="",
-                 fees=None):
-        super().__init__(index, type, inputs, outputs, timestamp, transactionId, fees)
-        self.objectDesc.databaseTableName = 'Unconfirmed_Transactions'
+    __slots__ = ()
 
 
-# ObjectDesc Class that is stored as an attribute in every class
-# This class enables the use of a single function to add/remove/update any object regardless of it's type
-class ObjectDesc:
-    def __init__(self, databaseTableName, databaseColumnNames, databaseValues, distinctAttrib, toPickleAttrib):
-        self.databaseTableName = databaseTableName
-        self.databaseColumnNames = databaseColumnNames
-        self.databaseValues = databaseValues
-        self.distinctAttrib = distinctAttrib
-        self.toPickleAttrib = toPickleAttrib
+# Schemas of the classes stored in the database
+Schema.register(Block, "Blocks",
+                ["id", "transactions", "timestamp", "previousHash", "hash", "reward", "nonce", "difficulty"],
+                "id", ["transactions"])
+Schema.register(Transaction, "Transactions",
+                ["id", "type", "inputs", "outputs", "timestamp", "transactionId", "fees"],
+                "transactionId", ["inputs", "outputs"])
+Schema.register(UnconfirmedTransaction, "Unconfirmed_Transactions",
+                ["id", "type", "inputs", "outputs", "timestamp", "transactionId", "fees"],
+                "transactionId", ["inputs", "outputs"])
+Schema.register(Output, "UTXO", ["id", "value", "address", "transactionId", "lockingScript"],
+                "lockingScript", [])
+
+
+# Codec Class that encodes the Inputs, Outputs, Transactions and Blocks stored in the database in a compact binary form
+# An encoded value starts with the codec's magic bytes and version, then every field is packed with struct:
+# a one byte tag giving its type followed by its value, strings and bytes are prefixed by their length
+class Codec:
+    magic = b"ISS"
+    version = 1
+    lengthFormat = struct.Struct("<I")
+    intFormat = struct.Struct("<q")
+    floatFormat = struct.Struct("<d")
+    # Type tags of the fields
+    NONE, BYTES, STRING, INT, FLOAT, LIST = range(6)
+    # Kind tags of the objects
+    INPUT, OUTPUT, TRANSACTION, UNCONFIRMED_TRANSACTION, BLOCK = range(6, 11)
+
+    # Function that encodes the designed value: an object, a list of objects or a plain field
+    @staticmethod
+    def encode(value):
+        buffer = bytearray(Codec.magic)
+        buffer.append(Codec.version)
+        Codec.write(buffer, value)
+        return bytes(buffer)
+
+    # Function that decodes an encoded value, values pickled by older versions are unpickled
+    @staticmethod
+    def decode(data):
+        if not data.startswith(Codec.magic):
+            return pickle.loads(data)
+        if data[len(Codec.magic)] != Codec.version:
+            raise ValueError("Unknown codec version {}".format(data[len(Codec.magic)]))
+        value, offset = Codec.read(memoryview(data), len(Codec.magic) + 1)
+        return value
+
+    # Function that checks if the designed data was encoded by the codec
+    @staticmethod
+    def isEncoded(data):
+        return isinstance(data, bytes) and data.startswith(Codec.magic)
+
+    # Function that appends the designed value to the buffer
+    @staticmethod
+    def write(buffer, value):
+        if value is None:
+            buffer.append(Codec.NONE)
+        elif isinstance(value, bytes):
+            buffer.append(Codec.BYTES)
+            buffer += Codec.lengthFormat.pack(len(value))
+            buffer += value
+        elif isinstance(value, str):
+            data = value.encode()
+            buffer.append(Codec.STRING)
+            buffer += Codec.lengthFormat.pack(len(data))
+            buffer += data
+        elif isinstance(value, int):
+            buffer.append(Codec.INT)
+            buffer += Codec.intFormat.pack(value)
+        elif isinstance(value, float):
+            buffer.append(Codec.FLOAT)
+            buffer += Codec.floatFormat.pack(value)
+        elif isinstance(value, list):
+            buffer.append(Codec.LIST)
+            buffer += Codec.lengthFormat.pack(len(value))
+            for item in value:
+                Codec.write(buffer, item)
+        elif isinstance(value, Input):
+            buffer.append(Codec.INPUT)
+            Codec.writeFields(buffer, value, ["value", "address", "prevTxId", "lockingScript", "scriptSig"])
+        elif isinstance(value, Output):
+            buffer.append(Codec.OUTPUT)
+            Codec.writeFields(buffer, value, ["id", "value", "address", "transactionId", "lockingScript"])
+        elif isinstance(value, Transaction):
+            if isinstance(value, UnconfirmedTransaction):
+                buffer.append(Codec.UNCONFIRMED_TRANSACTION)
+            else:
+                buffer.append(Codec.TRANSACTION)
+            Codec.writeFields(buffer, value, ["id", "type", "inputs", "outputs", "timestamp", "transactionId", "fees"])
+        elif isinstance(value, Block):
+            buffer.append(Codec.BLOCK)
+            Codec.writeFields(buffer, value, ["id", "transactions", "timestamp", "previousHash", "hash", "reward",
+                                              "nonce", "difficulty", "merkleRoot"])
+        else:
+            raise TypeError("Can't encode {}".format(type(value).__name__))
 
-    # Function that changes the instance's attributes
-    def setDatabaseValues(self, dict):
-        for attrib in dict:
-            if attrib != "objectDesc":
-                self.databaseValues[attrib] = dict[attrib]
+    # Function that appends the designed attributes of the object to the buffer, in order
+    @staticmethod
+    def writeFields(buffer, object, attribs):
+        for attrib in attribs:
+            Codec.write(buffer, getattr(object, attrib))
+
+    # Function that reads the value starting at the designed offset, returns the value and the offset that follows it
+    @staticmethod
+    def read(data, offset):
+        tag = data[offset]
+        offset += 1
+        if tag == Codec.NONE:
+            return None, offset
+        if tag == Codec.BYTES or tag == Codec.STRING:
+            length, = Codec.lengthFormat.unpack_from(data, offset)
+            offset += Codec.lengthFormat.size
+            value = bytes(data[offset:offset + length])
+            if tag == Codec.STRING:
+                value = value.decode()
+            return value, offset + length
+        if tag == Codec.INT:
+            return Codec.intFormat.unpack_from(data, offset)[0], offset + Codec.intFormat.size
+        if tag == Codec.FLOAT:
+            return Codec.floatFormat.unpack_from(data, offset)[0], offset + Codec.floatFormat.size
+        if tag == Codec.LIST:
+            length, = Codec.lengthFormat.unpack_from(data, offset)
+            offset += Codec.lengthFormat.size
+            value = []
+            for i in range(length):
+                item, offset = Codec.read(data, offset)
+                value.append(item)
+            return value, offset
+        if tag == Codec.INPUT:
+            fields, offset = Codec.readFields(data, offset, 5)
+            return Input(*fields), offset
+        if tag == Codec.OUTPUT:
+            fields, offset = Codec.readFields(data, offset, 5)
+            return Output(*fields), offset
+        if tag == Codec.TRANSACTION:
+            fields, offset = Codec.readFields(data, offset, 7)
+            return Transaction(*fields), offset
+        if tag == Codec.UNCONFIRMED_TRANSACTION:
+            fields, offset = Codec.readFields(data, offset, 7)
+            return UnconfirmedTransaction(*fields), offset
+        if tag == Codec.BLOCK:
+            fields, offset = Codec.readFields(data, offset, 9)
+            return Block(*fields), offset
+        raise ValueError("Unknown codec tag {}".format(tag))
+
+    # Function that reads the designed number of consecutive values
+    @staticmethod
+    def readFields(data, offset, count):
+        fields = []
+        for i in range(count):
+            field, offset = Codec.read(data, offset)
+            fields.append(field)
+        return fields, offset
 
 
 # Wallet class that stores the node's wallet info as his address, public/private keys, etc...
@@ -155,19 +744,20 @@ class Wallet:
         self.database = database
         self.pubkey = VerifyingKey.from_pem(open("Keys\\PublicKey.pem").read())
         self.privkey = SigningKey.from_pem(open("Keys\\PrivateKey.pem").read())
+        # The wallet's utxos and balances kept up to date by the database events
+        self.state = WalletState(database, self.address)
         self.amount = self.balance()
 
-    # Function that calculates the wallet's balance
+    # Function that returns the wallet's balance
     def balance(self):
-        self.amount = 0
-        # Getting the utxos that are owned by the wallet's address
-        utxos = self.database.getUtxoList(self.address)
-        # Adding all the utxos values
-        if utxos:
-            for i in range(0, len(utxos)):
-                self.amount += float(utxos[i].value)
+        self.amount = self.state.confirmed
         return self.amount
 
+    # Function that rebuilds the wallet's state from the database
+    def rebuildState(self):
+        self.state.rebuild()
+        return self.balance()
+
     # Function that creates a normal tx (type 2)
     def constructTx(self, transactionSender, transactionReceiver, transactionAmount):
         # Checking of the sender has enough money or if the receiver address is valid
@@ -176,8 +766,8 @@ class Wallet:
         else:
             # Creating a UnconfirmedTransaction instance
             transaction = UnconfirmedTransaction(self.database.getLastObjectId("Unconfirmed_Transactions") + 1, 2)
-            # Querying the UTXO table
-            utxos = self.database.getUtxoList(self.address)
+            # Spendable utxos of the wallet
+            utxos = self.state.spendable()
             transaction.addInput(self.outToIn(utxos[0]))
             s = 0
 
@@ -199,7 +789,6 @@ class Wallet:
             transaction.addOutput(self.createOutScript(out2))
 
             transaction.calculateFees()
-            transaction.objectDesc.setDatabaseValues(transaction.__dict__)
             return transaction
 
     # Function that creates a coinbase tx (transaction that rewards the miner and its type is 1)
@@ -213,7 +802,6 @@ class Wallet:
         transaction.addOutput(self.createOutScript(out))
 
         transaction.calculateFees()
-        transaction.objectDesc.setDatabaseValues(transaction.__dict__)
         return transaction
 
     # Function that returns the signature of the private key
@@ -226,118 +814,683 @@ class Wallet:
 
     # Function that creates the locking script of the output
     def createOutScript(self, out):
-        SEPERATOR = "<SEPERATOR>".encode()
-        outScript = self.pubkey.to_string() + SEPERATOR + str(
-            out.value).encode() + SEPERATOR + out.address.encode() + SEPERATOR + str(
-            out.transactionId).encode() + SEPERATOR + str(time.time()).encode()
-        out.lockingScript = outScript
-        out.objectDesc.setDatabaseValues(out.__dict__)
-        return out
+        return createLockingScript(self.pubkey.to_string(), out)
 
     # Function that returns the pending coins of the wallet
     def getPendingAmount(self, sender):
+        if sender == self.address:
+            return self.state.pending, self.state.incoming
         return self.database.getPendingAmount(sender)
 
 
+# WalletState Class that holds in memory the utxos of an address, its confirmed balance and the amounts it's sending
+# and receiving in the unconfirmed transactions
+# It's built from the database once then updated by the events of the database, so reading it costs no query
+class WalletState:
+    def __init__(self, database, address):
+        self.database = database
+        self.address = address
+        # Utxos of the address by locking script
+        self.utxos = {}
+        # Amounts sent and received by the address in every unconfirmed transaction by transactionId
+        self.pendingTxs = {}
+        self.confirmed = 0
+        self.pending = 0
+        self.incoming = 0
+        # The state is updated by the thread applying the pushes of the server while the GUI reads it
+        self.lock = threading.RLock()
+        self.rebuild()
+        database.addListener(self.update)
+
+    # Function that rebuilds the whole state from the database
+    def rebuild(self):
+        utxos = {utxo.lockingScript: utxo
+                 for utxo in self.database.iterObjects("UTXO", "address=:address", {'address': self.address})}
+        pendingTxs = {}
+        for transactionId, confirmed, sent, received in self.database.getAddressHistory(self.address):
+            if not confirmed:
+                pendingTxs[transactionId] = (sent, received)
+        with self.lock:
+            self.utxos = utxos
+            self.pendingTxs = pendingTxs
+            self.total()
+
+    # Function that computes the balances from the utxos and the unconfirmed transactions
+    def total(self):
+        with self.lock:
+            self.confirmed = sum(float(utxo.value) for utxo in self.utxos.values())
+            self.pending = sum(sent for sent, received in self.pendingTxs.values())
+            self.incoming = sum(received for sent, received in self.pendingTxs.values())
+
+    # Function that returns the utxos the address can spend, oldest first
+    def spendable(self):
+        with self.lock:
+            return list(self.utxos.values())
+
+    # Function that returns the utxo of the address locked by the designed script, None if there is none
+    def find(self, lockingScript):
+        with self.lock:
+            return self.utxos.get(lockingScript)
+
+    # Function called by the database after objects were added to or removed from one of its tables
+    def update(self, event, tableName, objects):
+        with self.lock:
+            self.applyEvent(event, tableName, objects)
+
+    # Function that applies an event of the database to the state
+    def applyEvent(self, event, tableName, objects):
+        if tableName == "UTXO":
+            for output in objects:
+                if event == "add" and output.address == self.address:
+                    self.utxos[output.lockingScript] = output
+                elif event == "remove":
+                    self.utxos.pop(output.lockingScript, None)
+        elif tableName == "Unconfirmed_Transactions":
+            for tx in objects:
+                if event == "add":
+                    sent = sum(input.value for input in self.database.decodedAttrib(tx.inputs)
+                               if input.address == self.address)
+                    received = sum(output.value for output in self.database.decodedAttrib(tx.outputs)
+                                   if output.address == self.address)
+                    if sent or received:
+                        self.pendingTxs[tx.transactionId] = (sent, received)
+                else:
+                    self.pendingTxs.pop(tx.transactionId, None)
+        else:
+            return
+        self.total()
+
+
+# UtxoSet Class that holds all the utxos in memory by compact outpoint, with an index by address
+# An input only names the output it spends by its transaction id and locking script, the hash of the locking script
+# gives its outpoint
+# The set is loaded from the UTXO table, or from a snapshot file when it matches the table, then it follows the
+# writes of the database through its events, which write the utxos of a block or a transaction in one batch
+class UtxoSet:
+    def __init__(self, database, snapshotPath=None):
+        self.database = database
+        self.snapshotPath = snapshotPath
+        # Utxos by compact outpoint
+        self.utxos = {}
+        # Compact outpoint of every utxo by hash of its locking script
+        self.byScript = {}
+        # Compact outpoints of the utxos of every address, in the order they were added
+        self.byAddress = {}
+        # Thread writing the last snapshot, see saveSnapshot()
+        self.writer = None
+        if not self.loadSnapshot():
+            self.loadFromDatabase()
+        database.addListener(self.update)
+
+    def __len__(self):
+        return len(self.utxos)
+
+    def __contains__(self, key):
+        return key in self.utxos
+
+    # Function that returns the utxo with the designed compact outpoint, None if there is none
+    def get(self, key):
+        return self.utxos.get(key)
+
+    # Function that returns the utxo of the designed transaction locked by the designed script, None if there is none
+    def find(self, transactionId, lockingScript):
+        utxo = self.utxos.get(self.byScript.get(outpoint(transactionId, lockingScript)[1]))
+        if utxo is None or utxo.transactionId != transactionId:
+            return None
+        return utxo
+
+    # Function that returns the utxos of the designed address
+    def getByAddress(self, address):
+        return [self.utxos[key] for key in self.byAddress.get(address, ())]
+
+    # Function that adds the designed utxos to the set, their outpoints are found from the Tx_Outputs table
+    # A utxo whose transaction isn't indexed there is keyed by its transaction id and the hash of its locking script
+    def add(self, utxos):
+        indexes = self.database.getOutputIndexes([utxo.transactionId for utxo in utxos])
+        for utxo in utxos:
+            scriptHash = outpoint(utxo.transactionId, utxo.lockingScript)[1]
+            index = indexes.get((utxo.transactionId, scriptHash))
+            if index is None:
+                print(f"[!] Output of {utxo.transactionId} missing from Tx_Outputs, it's kept by its locking script")
+                key = str(utxo.transactionId).encode() + scriptHash
+            else:
+                key = compactOutpoint(utxo.transactionId, index)
+            self.utxos[key] = utxo
+            self.byScript[scriptHash] = key
+            self.byAddress.setdefault(utxo.address, {})[key] = None
+
+    # Function that removes the designed utxos from the set
+    def remove(self, utxos):
+        for utxo in utxos:
+            key = self.byScript.pop(outpoint(utxo.transactionId, utxo.lockingScript)[1], None)
+            utxo = self.utxos.pop(key, None)
+            if utxo is None:
+                continue
+            keys = self.byAddress.get(utxo.address)
+            keys.pop(key, None)
+            if not keys:
+                del self.byAddress[utxo.address]
+
+    # Function that loads every utxo of the UTXO table, a few hundred at a time
+    def loadFromDatabase(self):
+        self.utxos = {}
+        self.byScript = {}
+        self.byAddress = {}
+        utxos = []
+        for utxo in self.database.iterObjects("UTXO"):
+            utxos.append(utxo)
+            if len(utxos) == 500:
+                self.add(utxos)
+                utxos = []
+        self.add(utxos)
+
+    # Function that returns what identifies the state of the UTXO table: the epoch and the last sequence number of
+    # the change log, that every write of the database goes through, with the number of utxos and the last utxo id
+    # None if the database keeps no change log, the snapshot can't be checked then
+    def fingerprint(self):
+        if not self.database.changeLog:
+            return None
+        epoch, firstSeq, lastSeq = self.database.getChangeLogState()
+        if epoch is None:
+            return None
+        return [epoch, lastSeq, self.database.metadata["UTXO"]["count"], self.database.getLastObjectId("UTXO")]
+
+    # Function that loads the set from its snapshot file
+    # Returns False if there is no snapshot or if the database was written since it was taken
+    def loadSnapshot(self):
+        fingerprint = self.fingerprint()
+        if self.snapshotPath is None or fingerprint is None:
+            return False
+        try:
+            with open(self.snapshotPath, "rb") as file:
+                snapshotFingerprint, entries = Codec.decode(file.read())
+        except (OSError, ValueError, TypeError, IndexError, struct.error, pickle.UnpicklingError):
+            return False
+        if snapshotFingerprint != fingerprint:
+            return False
+        self.utxos = {}
+        self.byScript = {}
+        self.byAddress = {}
+        for i in range(0, len(entries), 2):
+            key, utxo = entries[i], entries[i + 1]
+            self.utxos[key] = utxo
+            self.byScript[outpoint(utxo.transactionId, utxo.lockingScript)[1]] = key
+            self.byAddress.setdefault(utxo.address, {})[key] = None
+        return True
+
+    # Function that writes the set to its snapshot file along with the fingerprint of the database
+    # It must be called from the thread writing the database, so the set matches the fingerprint
+    # In the background the set is copied then encoded and written by another thread, a snapshot asked for while
+    # the previous one is still being written is skipped
+    def saveSnapshot(self, background=False):
+        fingerprint = self.fingerprint()
+        if self.snapshotPath is None or fingerprint is None:
+            return
+        if self.writer is not None and self.writer.is_alive():
+            if background:
+                return
+            self.writer.join()
+        utxos = dict(self.utxos)
+        if not background:
+            self.writeSnapshot(fingerprint, utxos)
+            return
+        self.writer = threading.Thread(target=self.writeSnapshot, args=(fingerprint, utxos), daemon=True)
+        self.writer.start()
+
+    # Function that writes the designed utxos and fingerprint to the snapshot file
+    # The file is replaced at once so a crash never leaves half a snapshot
+    def writeSnapshot(self, fingerprint, utxos):
+        entries = []
+        for key, utxo in utxos.items():
+            entries.append(key)
+            entries.append(utxo)
+        data = Codec.encode([fingerprint, entries])
+        with open(self.snapshotPath + ".tmp", "wb") as file:
+            file.write(data)
+        os.replace(self.snapshotPath + ".tmp", self.snapshotPath)
+
+    # Function called by the database after objects were added to or removed from one of its tables
+    def update(self, event, tableName, objects):
+        if tableName != "UTXO":
+            return
+        if event == "add":
+            self.add(objects)
+        else:
+            self.remove(objects)
+
+
+# Size of the page cache of every connection in KiB when the database is in WAL mode
+walCacheSize = 16 * 1024
+
+
 # Database Class that queries,adds,deletes and updates any data desired
 # on our defined classes (Blocks, UTXOS, Unconfirmed and Confirmed Transactions) in the database
 class Database:
-    def __init__(self, connection, cursor):
+    # Tables of the database, the metadata cache holds their row count and their first and last ids
+    tableNames = ["Blocks", "Transactions", "Unconfirmed_Transactions", "UTXO"]
+    # Tables whose changes are written to the Change_Log table when the change log is enabled
+    changeLogTables = ["Unconfirmed_Transactions", "UTXO"]
+    # Tables whose transactions also have their inputs and outputs stored one per row
+    # in the Tx_Inputs and Tx_Outputs tables
+    transactionTables = ["Transactions", "Unconfirmed_Transactions"]
+
+    # The connection in argument is the only one that writes, when the path of the database and a number of readers
+    # are given the database is switched to WAL mode and the queries made outside of a unit of work are spread over
+    # that many read-only connections, so they don't wait for the writer to commit
+    def __init__(self, connection, cursor, path=None, readers=0):
         self.conn = connection
         self.c = cursor
+        # Pool of read-only connections, None when every query goes through the writer connection
+        self.readers = None
+        if path is not None and readers > 0:
+            self.enableWal(self.conn)
+            self.readers = queue.LifoQueue()
+            for i in range(readers):
+                self.readers.put(self.openReader(path))
+        # Only one thread at a time writes through the writer connection
+        self.writeLock = threading.RLock()
+        # Thread running the unit of work in progress, its queries have to see its uncommitted writes
+        self.writer = None
+        self.metadata = {}
+        self.loadMetadata()
+        # Number of nested units of work currently open
+        self.depth = 0
+        # Functions called with the event ("add" or "remove"), the table name and the objects
+        # after objects were added to or removed from a table
+        self.listeners = []
+        # Events of the unit of work in progress, they are only sent once it's committed
+        self.events = []
+        # True when the changes of the tables in changeLogTables are logged, see enableChangeLog
+        self.changeLog = False
+
+    # Function that sets the designed connection in WAL mode: the readers are no longer blocked while a block is
+    # committed, the writes are only synced to the disk at the checkpoints and the page cache is bigger
+    @staticmethod
+    def enableWal(connection):
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("PRAGMA cache_size=-{}".format(walCacheSize))
+
+    # Function that opens a read-only connection to the designed database
+    @staticmethod
+    def openReader(path):
+        connection = sqlite3.connect("file:{}?mode=ro".format(path), uri=True, check_same_thread=False)
+        connection.execute("PRAGMA cache_size=-{}".format(walCacheSize))
+        return connection
+
+    # Context that gives a cursor to run a query: from one of the read-only connections,
+    # or from the writer connection when there are none or when the query is part of a unit of work
+    @contextmanager
+    def reading(self):
+        if self.readers is None or self.writer == threading.get_ident():
+            yield self.conn.cursor()
+            return
+        connection = self.readers.get()
+        try:
+            yield connection.cursor()
+        finally:
+            self.readers.put(connection)
+
+    # Function that closes the read-only connections
+    def close(self):
+        if self.readers is not None:
+            while not self.readers.empty():
+                self.readers.get().close()
+            self.readers = None
+
+    # Function that rebuilds the metadata cache of every table from SQLite
+    def loadMetadata(self):
+        for tableName in self.tableNames:
+            self.c.execute("SELECT count(*), min(id), max(id) FROM {}".format(tableName))
+            count, minId, maxId = self.c.fetchone()
+            self.metadata[tableName] = {"count": count, "minId": minId or 0, "maxId": maxId or 0}
+
+    # Function that updates the metadata cache of a table after a row was inserted
+    def rowInserted(self, tableName, index):
+        metadata = self.metadata[tableName]
+        if metadata["count"] == 0:
+            metadata["minId"] = metadata["maxId"] = index
+        else:
+            metadata["minId"] = min(metadata["minId"], index)
+            metadata["maxId"] = max(metadata["maxId"], index)
+        metadata["count"] += 1
+
+    # Function that updates the metadata cache of a table after rows were deleted
+    # The first and last ids are read back from the primary key index since the deleted ids are unknown
+    def rowsDeleted(self, tableName, count):
+        if count <= 0:
+            return
+        metadata = self.metadata[tableName]
+        metadata["count"] -= count
+        self.c.execute("SELECT min(id), max(id) FROM {}".format(tableName))
+        minId, maxId = self.c.fetchone()
+        metadata["minId"] = minId or 0
+        metadata["maxId"] = maxId or 0
 
     # Function that gets the last object id from the database
     def getLastObjectId(self, tableName):
-        if self.emptyTable(tableName):
-            return 0
-        else:
-            self.c.execute("SELECT max(id) FROM {}".format(tableName))
-            return self.c.fetchall()[0][0]
+        return self.metadata[tableName]["maxId"]
+
+    # Function that reads the last committed object id of the designed table
+    # The metadata cache already counts the rows of the unit of work in progress, a reader only sees committed ones
+    def getCommittedLastObjectId(self, tableName):
+        with self.reading() as cursor:
+            cursor.execute("SELECT ifnull(max(id), 0) FROM {}".format(tableName))
+            return cursor.fetchone()[0]
 
     # Function that gets the first object id from the database
     def getFirstObjectId(self, tableName):
-        if self.emptyTable(tableName):
-            return 0
-        else:
-            self.c.execute("SELECT min(id) FROM {}".format(tableName))
-            return self.c.fetchall()[0][0]
+        return self.metadata[tableName]["minId"]
 
     # Function that checks if the table in argument is empty
     def emptyTable(self, tableName):
-        self.c.execute("SELECT * FROM {};".format(tableName))
-        if self.c.fetchall():
-            return False
-        else:
-            return True
+        return self.metadata[tableName]["count"] == 0
 
-    # Function that gets the object by id from the database
+    # Function that gets the object by id from the database, None if there is no such object
     def getObjectById(self, tableName, index):
+        return self.rowToObject(tableName, self.getRawObjectById(tableName, index))
+
+    # Function that yields the objects of the designed table one at a time
+    # where is an optional SQL condition with named parameters taken from params
+    # The rows are fetched batchSize at a time and a row is only turned into an object (and its pickled
+    # attributes only unpickled) when the caller reaches it, so the table is never loaded in memory at once
+    def iterObjects(self, tableName, where=None, params=None, batchSize=500):
+        sql = "SELECT * FROM {}".format(tableName)
+        if where is not None:
+            sql += " WHERE {}".format(where)
+        # A cursor of its own so that the caller can query the database while iterating
+        with self.reading() as cursor:
+            cursor.execute(sql, params or {})
+            while True:
+                rows = cursor.fetchmany(batchSize)
+                if not rows:
+                    break
+                for row in rows:
+                    yield self.rowToObject(tableName, row)
+
+    # Function that transforms a row of the designed table to an object with its pickled attributes loaded
+    def rowToObject(self, tableName, row):
+        if row is None:
+            return None
+        object = self.rawToObject(tableName, row)
+        self.unpickleObjectAttrib(object)
         if tableName == "Blocks":
-            block = Block(*self.getRawObjectById(tableName, index))
-            self.unpickleObjectAttrib(block)
-            return block
-        if tableName == "Transactions":
-            tx = Transaction(*self.getRawObjectById(tableName, index))
-            self.unpickleObjectAttrib(tx)
-            return tx
-        if tableName == "Unconfirmed_Transactions":
-            tx = UnconfirmedTransaction(*self.getRawObjectById(tableName, index))
-            self.unpickleObjectAttrib(tx)
-            return tx
-        if tableName == "UTXO":
-            output = Output(*self.getRawObjectById(tableName, index))
-            self.unpickleObjectAttrib(output)
-            return output
+            object.updateMerkleRoot()
+        return object
 
     # Function that gets the object by id from the database
     def getRawObjectById(self, tableName, index):
-        self.c.execute("SELECT * FROM {} WHERE id=:id".format(tableName), {'id': index})
-        res = self.c.fetchall()
+        with self.reading() as cursor:
+            cursor.execute("SELECT * FROM {} WHERE id=:id".format(tableName), {'id': index})
+            res = cursor.fetchall()
         if res:
             return res[0]
         else:
             return None
 
-    # Function that transforms raw data to an object
+    # Function that returns the rows of the designed table whose id is between the two designed ids, in order
+    def getRawObjectsInRange(self, tableName, firstId, lastId):
+        with self.reading() as cursor:
+            cursor.execute("SELECT * FROM {} WHERE id BETWEEN ? AND ? ORDER BY id".format(tableName), (firstId, lastId))
+            return cursor.fetchall()
+
+    # Function that transforms raw data to an object of the class registered for the designed table
     @staticmethod
     def rawToObject(tableName, rawData):
-        if tableName == "Blocks":
-            block = Block(*rawData)
-            return block
-        if tableName == "Transactions":
-            tx = Transaction(*rawData)
-            return tx
-        if tableName == "Unconfirmed_Transactions":
-            tx = UnconfirmedTransaction(*rawData)
-            return tx
-        if tableName == "UTXO":
-            output = Output(*rawData)
-            return output
+        return Schema.registry[tableName](*rawData)
 
     # Function that sets an id to the object that won't create a conflict in the database
     def setObjectId(self, object):
-        objectId = self.getLastObjectId(object.objectDesc.databaseTableName)
+        objectId = self.getLastObjectId(object.schema.tableName)
         object.id = objectId + 1
-        object.objectDesc.databaseValues['id'] = object.id
+
+    # Context in which all the writes are made in a single SQLite transaction that is committed once at the end
+    # Units of work can be nested, only the outermost one commits, if anything fails everything is rolled back
+    @contextmanager
+    def unitOfWork(self):
+        with self.writeLock:
+            self.depth += 1
+            self.writer = threading.get_ident()
+            try:
+                yield self
+            except BaseException:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.writer = None
+                    self.conn.rollback()
+                    # The writes were rolled back so the metadata cache is read again from SQLite
+                    self.loadMetadata()
+                    self.events = []
+                raise
+            self.depth -= 1
+            if self.depth == 0:
+                self.writer = None
+                self.conn.commit()
+                self.sendEvents()
+
+    # Function that adds a function called after objects were added to or removed from a table
+    def addListener(self, listener):
+        self.listeners.append(listener)
+
+    # Function that removes a listener added with addListener
+    def removeListener(self, listener):
+        self.listeners.remove(listener)
+
+    # Function that records a change of the unit of work in progress: it's written to the change log if it's kept
+    # and its event is sent to the listeners once the unit of work is committed
+    def recordChange(self, event, tableName, objects):
+        if not objects:
+            return
+        self.logChanges(event, tableName, objects)
+        if self.listeners:
+            self.events.append((event, tableName, objects))
+
+    # Function that makes the database keep a change log of the tables in changeLogTables
+    # The log belongs to an epoch, a random id given to the database the first time, so that a node never applies
+    # the log of another database on top of its state
+    def enableChangeLog(self):
+        self.changeLog = True
+        if self.getSyncState("changeLogEpoch") is None:
+            with self.unitOfWork():
+                self.setSyncState("changeLogEpoch", os.urandom(8).hex())
+
+    # Function that writes the designed change to the change log, in the unit of work that makes it
+    # An added object is logged with its id and its distinct attribute, a removed object with its distinct attribute
+    def logChanges(self, event, tableName, objects):
+        if not self.changeLog or tableName not in self.changeLogTables:
+            return
+        distAttrib = Schema.registry[tableName].schema.distinctAttrib
+        self.c.executemany(
+            "INSERT INTO Change_Log (tableName, event, objectId, distinctValue) VALUES (?, ?, ?, ?)",
+            [(tableName, event, object.id if event == "add" else None, getattr(object, distAttrib))
+             for object in objects])
+
+    # Function that returns the epoch of the change log, the sequence number of its first entry
+    # and the sequence number of its last entry (the sequence of the first entry is one more when it's empty)
+    def getChangeLogState(self):
+        with self.reading() as cursor:
+            cursor.execute("SELECT seq FROM sqlite_sequence WHERE name='Change_Log'")
+            row = cursor.fetchone()
+            lastSeq = row[0] if row else 0
+            cursor.execute("SELECT min(seq) FROM Change_Log")
+            firstSeq = cursor.fetchone()[0] or lastSeq + 1
+        return self.getSyncState("changeLogEpoch"), firstSeq, lastSeq
+
+    # Function that returns the changes logged after the designed sequence number up to the second one
+    # Only the last change of every object is kept: ("add", table name, raw row) or ("remove", table name,
+    # distinct attribute), an object added then removed is only removed
+    def getChanges(self, afterSeq, lastSeq):
+        final = {}
+        with self.reading() as cursor:
+            cursor.execute("SELECT tableName, event, objectId, distinctValue FROM Change_Log "
+                           "WHERE seq > ? AND seq <= ? ORDER BY seq", (afterSeq, lastSeq))
+            for tableName, event, objectId, distinctValue in cursor.fetchall():
+                final.pop((tableName, distinctValue), None)
+                final[(tableName, distinctValue)] = (event, objectId)
+        changes = []
+        for (tableName, distinctValue), (event, objectId) in final.items():
+            if event == "add":
+                rawData = self.getRawObjectById(tableName, objectId)
+                # The row may have been replaced since, then the object doesn't exist anymore
+                distAttrib = Schema.registry[tableName].schema.distinctAttrib
+                if rawData is not None and getattr(self.rawToObject(tableName, rawData), distAttrib) == distinctValue:
+                    changes.append(("add", tableName, rawData))
+                    continue
+            changes.append(("remove", tableName, distinctValue))
+        return changes
+
+    # Function that deletes the oldest entries of the change log so that it holds at most the designed number
+    # The nodes that applied none of the remaining entries will synchronize the whole tables again
+    def trimChangeLog(self, keep):
+        with self.unitOfWork():
+            self.c.execute("DELETE FROM Change_Log WHERE seq <= (SELECT max(seq) FROM Change_Log) - ?", (keep,))
+
+    # Function that returns the designed synchronization value, None if it was never set
+    def getSyncState(self, name):
+        with self.reading() as cursor:
+            cursor.execute("SELECT value FROM Sync_State WHERE name=:name", {'name': name})
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    # Function that sets the designed synchronization value, it's committed by the unit of work it's part of
+    def setSyncState(self, name, value):
+        self.c.execute("INSERT OR REPLACE INTO Sync_State VALUES (?, ?)", (name, value))
+
+    # Function that returns the objects of the designed table whose distinct attribute is one of the designed values
+    def getObjectsByKey(self, tableName, values):
+        distAttrib = Schema.registry[tableName].schema.distinctAttrib
+        objects = []
+        for value in values:
+            objects.extend(self.iterObjects(tableName, "{0}=:{0}".format(distAttrib), {distAttrib: value}))
+        return objects
+
+    # Function that sends the events of the committed unit of work to the listeners
+    def sendEvents(self):
+        events, self.events = self.events, []
+        for event, tableName, objects in events:
+            for listener in self.listeners:
+                listener(event, tableName, objects)
 
     # Function that adds the designed object to the database
     def addObject(self, object, definitive=False):
-        if not definitive:
-            self.setObjectId(object)
-        self.pickleObjectAttrib(object)
-        with self.conn:
-            self.c.execute(
-                "INSERT INTO {} VALUES {}".format(object.objectDesc.databaseTableName,
-                                                  object.objectDesc.databaseColumnNames),
-                object.objectDesc.databaseValues)
+        with self.unitOfWork():
+            self.insertObject(object, definitive)
 
     # Function that removes the designed object from the database
     def removeObject(self, object):
-        distAttrib = object.objectDesc.distinctAttrib
+        with self.unitOfWork():
+            self.deleteObject(object)
+
+    # Function that adds the designed objects to the database with one statement per table
+    def addObjects(self, objects, definitive=False):
+        with self.unitOfWork():
+            for tableName, tableObjects in self.groupByTable(objects).items():
+                schema = tableObjects[0].schema
+                for object in tableObjects:
+                    if not definitive:
+                        self.setObjectId(object)
+                    self.rowInserted(tableName, object.id)
+                self.c.executemany("INSERT INTO {} VALUES {}".format(tableName, schema.columnNames),
+                                   [schema.rowValues(object) for object in tableObjects])
+                self.indexTransactions(tableName, tableObjects)
+                self.recordChange("add", tableName, tableObjects)
+
+    # Function that removes the designed objects from their tables (or from the designed table)
+    # with one statement per table
+    def removeObjects(self, objects, tableName=None):
+        with self.unitOfWork():
+            for objectsTable, tableObjects in self.groupByTable(objects).items():
+                if tableName is not None:
+                    objectsTable = tableName
+                distAttrib = tableObjects[0].schema.distinctAttrib
+                self.c.executemany(
+                    "DELETE FROM {0} WHERE {1}=:{1}".format(objectsTable, distAttrib),
+                    [{distAttrib: getattr(object, distAttrib)} for object in tableObjects])
+                self.rowsDeleted(objectsTable, self.c.rowcount)
+                self.unindexTransactions(objectsTable, tableObjects)
+                self.recordChange("remove", objectsTable, tableObjects)
+
+    # Function that groups the designed objects by the table they belong to, keeping their order
+    @staticmethod
+    def groupByTable(objects):
+        tables = {}
+        for object in objects:
+            tables.setdefault(object.schema.tableName, []).append(object)
+        return tables
+
+    # Function that inserts the designed object, it's committed by the unit of work it's part of
+    def insertObject(self, object, definitive=False):
+        if not definitive:
+            self.setObjectId(object)
+        schema = object.schema
+        self.c.execute("INSERT INTO {} VALUES {}".format(schema.tableName, schema.columnNames),
+                       schema.rowValues(object))
+        self.rowInserted(schema.tableName, self.c.lastrowid)
+        self.indexTransactions(schema.tableName, [object])
+        self.recordChange("add", schema.tableName, [object])
+
+    # Function that deletes the designed object from its table (or from the designed table),
+    # it's committed by the unit of work it's part of
+    def deleteObject(self, object, tableName=None):
+        if tableName is None:
+            tableName = object.schema.tableName
+        distAttrib = object.schema.distinctAttrib
         self.c.execute(
-            "DELETE FROM {0} WHERE {1}=:{1}".format(object.objectDesc.databaseTableName, distAttrib),
-            {'{}'.format(distAttrib): object.objectDesc.databaseValues[distAttrib]})
-        self.conn.commit()
+            "DELETE FROM {0} WHERE {1}=:{1}".format(tableName, distAttrib),
+            {'{}'.format(distAttrib): getattr(object, distAttrib)})
+        self.rowsDeleted(tableName, self.c.rowcount)
+        self.unindexTransactions(tableName, [object])
+        self.recordChange("remove", tableName, [object])
+
+    # Function that stores the inputs and outputs of the designed transactions of the designed table
+    # in the Tx_Inputs and Tx_Outputs tables, a row per input or output with its transaction id, its index,
+    # its address, its value and its outpoint, where the outpoint of an input is the one of the output it spends
+    # A confirmed transaction replaces the rows it had while it was unconfirmed
+    def indexTransactions(self, tableName, transactions):
+        if tableName not in self.transactionTables:
+            return
+        confirmed = int(tableName == "Transactions")
+        inputRows = []
+        outputRows = []
+        for tx in transactions:
+            for i, input in enumerate(self.decodedAttrib(tx.inputs)):
+                prevTxId, scriptHash = outpoint(input.prevTxId, input.lockingScript)
+                inputRows.append((tx.transactionId, i, input.address, input.value, prevTxId, scriptHash, confirmed))
+            for i, output in enumerate(self.decodedAttrib(tx.outputs)):
+                scriptHash = outpoint(tx.transactionId, output.lockingScript)[1]
+                outputRows.append((tx.transactionId, i, output.address, output.value, scriptHash, confirmed))
+        self.c.executemany("INSERT OR REPLACE INTO Tx_Inputs VALUES (?, ?, ?, ?, ?, ?, ?)", inputRows)
+        self.c.executemany("INSERT OR REPLACE INTO Tx_Outputs VALUES (?, ?, ?, ?, ?, ?)", outputRows)
+
+    # Function that deletes the inputs and outputs of the designed transactions of the designed table
+    # from the Tx_Inputs and Tx_Outputs tables
+    def unindexTransactions(self, tableName, transactions):
+        if tableName not in self.transactionTables:
+            return
+        confirmed = int(tableName == "Transactions")
+        rows = [(tx.transactionId, confirmed) for tx in transactions]
+        self.c.executemany("DELETE FROM Tx_Inputs WHERE transactionId=? AND confirmed=?", rows)
+        self.c.executemany("DELETE FROM Tx_Outputs WHERE transactionId=? AND confirmed=?", rows)
+
+    # Function that returns the inputs or outputs of a transaction, raw rows received from the server
+    # hold them encoded
+    @staticmethod
+    def decodedAttrib(value):
+        if isinstance(value, bytes):
+            return Codec.decode(value)
+        return value
+
+    # Function that adds a mined block to the database in a single transaction
+    # Its transactions are moved from the Unconfirmed_Transactions table to the Transactions table
+    # and their outputs are added to the UTXO table
+    def acceptBlock(self, block):
+        with self.unitOfWork():
+            self.addObject(block)
+            self.addObjects(block.transactions)
+            # Transactions of type 2 are regular transactions from node to node, they were unconfirmed
+            # Transactions of type 1 reward the miner for mining the block, they were never unconfirmed
+            self.removeObjects([tx for tx in block.transactions if tx.type == 2], "Unconfirmed_Transactions")
+            self.addObjects([output for tx in block.transactions for output in tx.outputs])
 
     # Function that returns the first object in the designed table
     def getFirstObject(self, tableName):
@@ -346,77 +1499,101 @@ class Database:
 
     # Function that returns a list of all UTXOS that have the designed address
     def getUtxoList(self, address):
-        self.c.execute("SELECT * FROM UTXO WHERE address=:address", {'address': address})
-        utxos = self.c.fetchall()
-        utxoList = []
-        if len(utxos) != 0:
-            for i in range(0, len(utxos)):
-                utxoList.append(Output(*utxos[i]))
-        return utxoList
+        return list(self.iterObjects("UTXO", "address=:address", {'address': address}))
 
     # Function that returns the UTXO that have the designed locking script
     def getUtxoByScript(self, lockingScript):
-        self.c.execute("SELECT * FROM UTXO WHERE lockingScript=:lockingScript", {'lockingScript': lockingScript})
-        utxoId = self.c.fetchall()[0][0]
-        return self.getObjectById("UTXO", utxoId)
+        return next(self.iterObjects("UTXO", "lockingScript=:lockingScript", {'lockingScript': lockingScript}), None)
 
     # Function that returns the tx that have the designed tx id
     def getTxByTxId(self, transactionId):
-        try:
-            self.c.execute("SELECT * FROM Transactions WHERE transactionId=:transactionId",
-                           {'transactionId': transactionId})
-            TxId = self.c.fetchall()[0][0]
-            return self.getObjectById("Transactions", TxId)
-        except IndexError:
-            try:
-                self.c.execute("SELECT * FROM Unconfirmed_Transactions WHERE transactionId=:transactionId",
-                               {'transactionId': transactionId})
-                TxId = self.c.fetchall()[0][0]
-                return self.getObjectById("Unconfirmed_Transactions", TxId)
-            except IndexError:
-                return None
+        for tableName in ["Transactions", "Unconfirmed_Transactions"]:
+            tx = next(self.iterObjects(tableName, "transactionId=:transactionId", {'transactionId': transactionId}),
+                      None)
+            if tx is not None:
+                return tx
+        return None
 
     # Function that returns a list of objects from the designed table
     def getObjectList(self, tableName):
-        res = []
-        self.c.execute("SELECT * FROM {}".format(tableName))
-        for i in self.c.fetchall():
-            res.append(self.getObjectById(tableName, i[0]))
-        return res
+        return list(self.iterObjects(tableName))
+
+    # Function that returns the index of the outputs of the designed transactions in their transaction
+    # by transaction id and hash of the locking script
+    def getOutputIndexes(self, transactionIds):
+        indexes = {}
+        transactionIds = list(set(transactionIds))
+        with self.reading() as cursor:
+            for i in range(0, len(transactionIds), 500):
+                batch = transactionIds[i:i + 500]
+                cursor.execute("SELECT transactionId, scriptHash, outputIndex FROM Tx_Outputs "
+                               "WHERE transactionId IN ({})".format(", ".join("?" * len(batch))), batch)
+                for transactionId, scriptHash, index in cursor.fetchall():
+                    indexes[(transactionId, scriptHash)] = index
+        return indexes
+
+    # Function that returns the address and the value of the outputs of the designed transactions
+    # by transaction id and hash of the locking script
+    def getOutputs(self, transactionIds):
+        outputs = {}
+        transactionIds = list(set(transactionIds))
+        with self.reading() as cursor:
+            for i in range(0, len(transactionIds), 500):
+                batch = transactionIds[i:i + 500]
+                cursor.execute("SELECT transactionId, scriptHash, address, value FROM Tx_Outputs "
+                               "WHERE transactionId IN ({})".format(", ".join("?" * len(batch))), batch)
+                for transactionId, scriptHash, address, value in cursor.fetchall():
+                    outputs[(transactionId, scriptHash)] = (address, value)
+        return outputs
 
     # Function that returns a list of ids from the designed table
     def getObjectIdList(self, tableName):
-        self.c.execute("SELECT id FROM {}".format(tableName))
-        return self.c.fetchall()
+        with self.reading() as cursor:
+            cursor.execute("SELECT id FROM {}".format(tableName))
+            return cursor.fetchall()
 
-    # Function that pickles all the attributes in the toPickleAttrib of the designed object
-    @staticmethod
-    def pickleObjectAttrib(object):
-        for attrib in object.objectDesc.toPickleAttrib:
-            object.objectDesc.databaseValues[attrib] = pickle.dumps(object.objectDesc.databaseValues[attrib])
-
-    # Function that unpickles all the attributes in the toPickleAttrib of the designed object
+    # Function that decodes the encoded attributes of the designed object
+    # Attributes pickled by older versions are still read
     @staticmethod
     def unpickleObjectAttrib(object):
-        for attrib in object.objectDesc.toPickleAttrib:
-            object.__dict__[attrib] = pickle.loads(object.objectDesc.databaseValues[attrib])
+        for attrib in object.schema.encodedAttribs:
+            setattr(object, attrib, Codec.decode(getattr(object, attrib)))
 
-    # Function that returns how many coins are pending
+    # Function that returns how many coins are pending: the amount the designed address is sending
+    # and the amount it is receiving in the unconfirmed transactions
     def getPendingAmount(self, sender):
-        pending = 0
-        moneyIn = 0
-        unconfTxList = self.getObjectList("Unconfirmed_Transactions")
-        for unconfTx in unconfTxList:
-            inputs = unconfTx.inputs
-            outputs = unconfTx.outputs
-            for input in inputs:
-                if input.address == sender:
-                    pending += input.value
-            for output in outputs:
-                if output.address == sender:
-                    moneyIn += output.value
+        with self.reading() as cursor:
+            cursor.execute("SELECT total(value) FROM Tx_Inputs WHERE address=:address AND confirmed=0",
+                           {'address': sender})
+            pending = cursor.fetchone()[0]
+            cursor.execute("SELECT total(value) FROM Tx_Outputs WHERE address=:address AND confirmed=0",
+                           {'address': sender})
+            moneyIn = cursor.fetchone()[0]
         return pending, moneyIn
 
+    # Function that returns the history of the designed address: a row per transaction it took part in
+    # with the transaction id, 1 if it's confirmed or 0 if not, the amount sent and the amount received
+    def getAddressHistory(self, address):
+        with self.reading() as cursor:
+            cursor.execute("""SELECT transactionId, max(confirmed), total(sent), total(received) FROM (
+                                  SELECT transactionId, confirmed, value AS sent, 0 AS received
+                                  FROM Tx_Inputs WHERE address=:address
+                                  UNION ALL
+                                  SELECT transactionId, confirmed, 0, value FROM Tx_Outputs WHERE address=:address)
+                              GROUP BY transactionId""", {'address': address})
+            return cursor.fetchall()
+
+    # Function that checks if the output locked by the designed script in the designed transaction is spent
+    # by a confirmed transaction, or by any transaction when pending is True
+    def isSpent(self, transactionId, lockingScript, pending=False):
+        prevTxId, scriptHash = outpoint(transactionId, lockingScript)
+        sql = "SELECT 1 FROM Tx_Inputs WHERE prevTxId=:prevTxId AND scriptHash=:scriptHash"
+        if not pending:
+            sql += " AND confirmed=1"
+        with self.reading() as cursor:
+            cursor.execute(sql + " LIMIT 1", {'prevTxId': prevTxId, 'scriptHash': scriptHash})
+            return cursor.fetchone() is not None
+
     # Function that searches for a Block or Tx with the designed parameter
     def search(self, param):
         try:
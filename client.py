@@ -1,9 +1,18 @@
 import pickle
+import socket
+import threading
+import time
+from classes import Miner, Schema
+from protocol import Connection
+
+# Seconds waited before subscribing again after the push connection was lost, doubled after every failed attempt
+minResubscribeDelay = 1
+maxResubscribeDelay = 60
 
 
 # Client Class with it's basic attributes
 class Client:
-    def __init__(self, database, minBufferSize, host, port, s, keysDir, wallet):
+    def __init__(self, database, minBufferSize, host, port, s, keysDir, wallet, miningWorkers=None, poolMode=False):
         self.database = database
         self.minBufferSize = minBufferSize
         self.host = host
@@ -11,6 +20,16 @@ class Client:
         self.socket = s
         self.keysDir = keysDir
         self.wallet = wallet
+        # Number of processes used to mine a block, None uses all the cores
+        self.miningWorkers = miningWorkers
+        # In pool mode the server hands the node nonce ranges instead of letting it search the whole nonce space
+        self.poolMode = poolMode
+        # Messages exchanged with the server, in the version of the protocol agreed on in identify()
+        self.connection = Connection(s)
+        # Client holding the connection the server pushes the new blocks and transactions to, see subscribe()
+        self.subscriber = None
+        # Set by the node's close() so that its subscriber stops instead of subscribing again
+        self.closing = False
 
     # Function that starts the connection to the server
     def start(self):
@@ -25,119 +44,281 @@ class Client:
         print("[+] Connected.")
 
     # Sending our wallet address to the server
+    # The highest version of the protocol is asked for at the same time, a server that only speaks version 1
+    # reads the login as usual and the node speaks version 1
     def identify(self):
-        length = str(len(self.wallet.address))
-        self.socket.send(self.toMinSize(length).encode())
-        self.socket.send(self.wallet.address.encode())
+        self.connection.login(self.wallet.address)
 
+    # Function that downloads the changes made on the server's database since the last connection
+    # With version 2 of the protocol the blocks and transactions are committed chunk by chunk, so an interrupted
+    # synchronization resumes where it stopped, otherwise the whole synchronization is committed at once at the end
     def updateDatabase(self):
-        tableNames = ["Blocks", "Transactions", "Unconfirmed_Transactions", "UTXO"]
-        for tableName in tableNames:
-            if tableName == "Blocks" or tableName == "Transactions":
-                # Receiving the id of the last object in table
-                lastId = int(self.socket.recv(self.minBufferSize))
-                # Getting the id of the last object then sending it to the server
-                m = self.database.getLastObjectId(tableName)
-                self.socket.send(str(m).encode())
-
-                # Receiving and adding the missing objects
+        if self.connection.version >= 2:
+            for tableName in ["Blocks", "Transactions"]:
+                self.exchangeLastIds(tableName)
+                self.receiveChunks(tableName)
+            with self.database.unitOfWork():
+                self.syncChanges()
+            return
+
+        with self.database.unitOfWork():
+            for tableName in ["Blocks", "Transactions"]:
+                m, lastId = self.exchangeLastIds(tableName)
+                # Receiving the missing objects then adding them all at once
+                objects = []
                 for i in range(m + 1, lastId + 1):
-                    length = int(self.socket.recv(self.minBufferSize).decode().strip())
-                    object = pickle.loads(self.socket.recv(length))
-                    self.database.addObject(self.database.rawToObject(tableName, object), True)
-            else:
-                length = int(self.socket.recv(self.minBufferSize))
-                # Receiving the set that contains the object ids from the server
-                set1 = pickle.loads(self.socket.recv(length))
-
-                # Sending the set that contains the object ids to the server
-                set2 = pickle.dumps(set(self.database.getObjectIdList(tableName)))
-                length = self.toMinSize(str(len(set2))).encode()
-                self.socket.send(length)
-                self.socket.send(set2)
-
-                set2 = pickle.loads(set2)
-                # Elements that are missing
-                toAdd = set1 - set2
-
-                if toAdd:
-                    for i in range(0, len(toAdd)):
-                        length = int(self.socket.recv(self.minBufferSize))
-                        object = pickle.loads(self.socket.recv(length))
-                        self.database.addObject(object, definitive=True)
-
-                # Elements that are in excess
-                toDelete = set2 - set1
-
-                if toDelete:
-                    for elmnt in toDelete:
-                        self.database.removeObject(self.database.getObjectById(tableName, elmnt[0]))
+                    objects.append(self.database.rawToObject(tableName, self.connection.receiveObject()))
+                self.database.addObjects(objects, True)
+
+            for tableName in ["Unconfirmed_Transactions", "UTXO"]:
+                self.syncIds(tableName)
+
+    # Function that receives the id of the server's last object of the designed table then sends the node's
+    # Returns the node's last id then the server's
+    def exchangeLastIds(self, tableName):
+        # Receiving the id of the last object in table
+        lastId = self.connection.receiveInt()
+        # Getting the id of the last object then sending it to the server
+        m = self.database.getLastObjectId(tableName)
+        self.connection.sendInt(m)
+        return m, lastId
+
+    # Function that opens a second connection the server pushes the new blocks and transactions to
+    # A thread applies them as they come and calls onPush with the kind of every push applied
+    # Returns False if the server only speaks version 1 of the protocol
+    def subscribe(self, onPush=None):
+        subscriber = Client(self.database, self.minBufferSize, self.host, self.port, socket.socket(), self.keysDir,
+                            self.wallet)
+        subscriber.start()
+        if subscriber.connection.version < 2:
+            subscriber.close()
+            return False
+        # The server subscribes the connection then synchronizes it again before pushing
+        subscriber.connection.sendInt(5)
+        subscriber.updateDatabase()
+        self.subscriber = subscriber
+        threading.Thread(target=subscriber.listen, args=(onPush,), daemon=True).start()
+        return True
+
+    # Function that applies the pushes of the server until the node is closed
+    # When the connection is lost, when the server drops it for falling behind or when a push can't be applied,
+    # the node subscribes again on a new connection and synchronizes, onPush is then called with "sync"
+    def listen(self, onPush):
+        delay = minResubscribeDelay
+        while not self.closing:
+            push = self.connection.receivePush()
+            if push is not None:
+                try:
+                    self.applyPush(push)
+                except Exception as e:
+                    print(f"[!] Push of the server not applied: {e!r}")
+                    push = None
+            if push is not None:
+                delay = minResubscribeDelay
+                if onPush is not None:
+                    onPush(push[0])
+                continue
+            while not self.closing:
+                try:
+                    self.resubscribe()
+                    break
+                except Exception as e:
+                    print(f"[!] Push connection lost, subscribing again in {delay}s: {e!r}")
+                    time.sleep(delay)
+                    delay = min(delay * 2, maxResubscribeDelay)
+            if not self.closing and onPush is not None:
+                onPush("sync")
+        self.socket.close()
+
+    # Function that replaces the push connection by a new one, the node is synchronized again before the pushes
+    def resubscribe(self):
+        self.socket.close()
+        self.socket = socket.socket()
+        self.connection = Connection(self.socket)
+        self.start()
+        if self.connection.version < 2:
+            raise ConnectionError("The server doesn't push its changes anymore")
+        self.connection.sendInt(5)
+        self.updateDatabase()
+
+    # Function that applies a push of the server in one transaction
+    # The rows and changes already received with the synchronization are skipped
+    def applyPush(self, push):
+        with self.database.unitOfWork():
+            if push[0] == "rows":
+                tableName, rows = push[1], push[2]
+                lastId = self.database.getLastObjectId(tableName)
+                self.database.addObjects(
+                    [self.database.rawToObject(tableName, row) for row in rows if row[0] > lastId], True)
+            elif push[0] == "changes":
+                epoch, lastSeq, changes = push[1], push[2], push[3]
+                if epoch == self.database.getSyncState("serverEpoch") and \
+                        lastSeq > int(self.database.getSyncState("serverSeq") or 0):
+                    self.applyChanges(changes)
+                    self.database.setSyncState("serverSeq", lastSeq)
+
+    # Function that receives the rows of the designed table chunk by chunk until the empty chunk
+    # Every chunk is added in its own transaction, the synchronization stops at the first invalid chunk
+    def receiveChunks(self, tableName):
+        while True:
+            rows = self.connection.receiveChunk()
+            if rows is None:
+                raise ConnectionError("Invalid chunk of the {} table received from the server".format(tableName))
+            if not rows:
+                break
+            with self.database.unitOfWork():
+                self.database.addObjects([self.database.rawToObject(tableName, row) for row in rows], True)
+
+    # Function that downloads the changes of the UTXO and Unconfirmed_Transactions tables since the last
+    # synchronization, the server tells if it's sending them or if the whole tables have to be compared
+    # The epoch and the sequence number of the server's change log are saved with the changes
+    def syncChanges(self):
+        epoch = self.database.getSyncState("serverEpoch")
+        seq = int(self.database.getSyncState("serverSeq") or 0)
+        self.connection.sendObject((epoch, seq))
+        reply = self.connection.receiveObject()
+        if reply[0] == "delta":
+            self.applyChanges(reply[3])
+        else:
+            for tableName in ["Unconfirmed_Transactions", "UTXO"]:
+                self.syncIds(tableName)
+        self.database.setSyncState("serverEpoch", reply[1])
+        self.database.setSyncState("serverSeq", reply[2])
+
+    # Function that applies the changes sent by the server, an added object replaces the local one
+    # with the same distinct attribute
+    def applyChanges(self, changes):
+        for tableName in ["Unconfirmed_Transactions", "UTXO"]:
+            added = [self.database.rawToObject(tableName, change[2]) for change in changes
+                     if change[0] == "add" and change[1] == tableName]
+            removed = [change[2] for change in changes if change[0] == "remove" and change[1] == tableName]
+            distAttrib = Schema.registry[tableName].schema.distinctAttrib
+            removed += [getattr(object, distAttrib) for object in added]
+            self.database.removeObjects(self.database.getObjectsByKey(tableName, removed))
+            self.database.addObjects(added, definitive=True)
+
+    # Function that compares the ids of the designed table with the server's then downloads the missing objects
+    # and deletes the ones in excess
+    def syncIds(self, tableName):
+        # Receiving the set that contains the object ids from the server
+        set1 = self.connection.receiveObject()
+
+        # Sending the set that contains the object ids to the server
+        set2 = set(self.database.getObjectIdList(tableName))
+        self.connection.sendObject(set2)
+
+        # Elements that are missing
+        toAdd = set1 - set2
+
+        objects = []
+        for i in range(0, len(toAdd)):
+            objects.append(self.connection.receiveObject())
+        self.database.addObjects(objects, definitive=True)
+
+        # Elements that are in excess
+        toDelete = set2 - set1
+
+        self.database.removeObjects(
+            [self.database.getObjectById(tableName, elmnt[0]) for elmnt in toDelete])
 
     def transact(self, transactionSender, transactionReceiver, transactionAmount):
         # Constructing the transaction
         tx = self.wallet.constructTx(transactionSender, transactionReceiver, int(transactionAmount))
         if tx is not None:
-            pickledTx = pickle.dumps(tx)
             # Signaling the server that there is a new issued transaction
-            self.socket.send(self.toMinSize("2").encode())
+            self.connection.sendInt(2)
 
             # Sending the transaction to the server
-            length = str(len(pickledTx))
-            self.socket.send(self.toMinSize(length).encode())
-            self.socket.send(pickledTx)
+            self.connection.sendObject(tx)
 
             # Getting the confirmation from the server then adding the tx to the database
-            # Removing all the spent UTXO'S from the database
-            res = self.socket.recv(self.minBufferSize).strip().decode()
-            if res == "100":
-                self.database.addObject(tx)
-                for input in tx.inputs:
-                    self.database.removeObject(self.database.getUtxoByScript(input.lockingScript))
-            return True
-        else:
-            return None
+            # Removing all the spent UTXO'S from the database, a subscribed node receives them in a push instead
+            if self.connection.receiveInt() == 100:
+                if self.subscriber is not None:
+                    return True
+                # The spent utxos are the wallet's own, they are found in its state
+                with self.database.unitOfWork():
+                    self.database.addObject(tx)
+                    self.database.removeObjects([self.wallet.state.find(input.lockingScript) for input in tx.inputs])
+                return True
+        return None
 
     # Function that requests the newest block info
     def blockInfo(self):
-        self.socket.send(b"00001")
-        length = int(self.socket.recv(self.minBufferSize))
-        if length == 0:
+        self.connection.sendInt(1)
+        template = self.connection.receiveBytes()
+        if not template:
             return 0
         else:
-            block = pickle.loads(self.socket.recv(length))
+            block = pickle.loads(template)
+            # Checking that the block's Merkle root commits to the transactions it contains
+            if not block.verifyMerkleRoot():
+                return 0
             return block
 
     def mine(self, block):
         # Signaling the server that we are mining
-        self.socket.send(b"00001")
-        block.mine(self.wallet)
+        self.connection.sendInt(1)
+        block.mine(self.wallet, self.miningWorkers)
         # Sending the result block to the server
-        length = str(len(pickle.dumps(block)))
-        self.socket.send(self.toMinSize(length).encode())
-        self.socket.send(pickle.dumps(block))
+        self.connection.sendObject(block)
         # Receiving confirmation about the block then adding it to the database
-        if int(self.socket.recv(self.minBufferSize).decode().strip()) == 100:
-            self.database.addObject(block)
-            # Removing every tx from the Unconfirmed_Transactions table to the Transactions table
-            # And adding the txs outputs
-            for tx in block.transactions:
-                if tx.type == 2:
-                    self.database.addObject(tx)
-                    self.database.removeObject(self.database.getFirstObject("Unconfirmed_Transactions"))
-                    for output in tx.outputs:
-                        self.database.addObject(output)
-                elif tx.type == 1:
-                    self.database.addObject(tx)
-                    for output in tx.outputs:
-                        self.database.addObject(output)
+        # A subscribed node receives the block in a push instead
+        if self.connection.receiveInt() == 100 and self.subscriber is None:
+            # Adding the block, moving its transactions from the Unconfirmed_Transactions table to the
+            # Transactions table and adding their outputs in one step
+            self.database.acceptBlock(block)
+
+    # Function that mines in pool mode: the server hands the node disjoint nonce ranges of the current block
+    # until the node finds a valid hash or until another node solves the block first
+    # Returns True if the node's block was accepted, False if it lost the race and None if there is no block to mine
+    def poolMine(self):
+        miner = Miner(self.miningWorkers)
+        try:
+            template = None
+            while True:
+                # Requesting a nonce range of the current block, the reward is split between the nodes of the pool
+                # and our share is paid to our public key
+                self.connection.sendInt(4)
+                self.connection.sendBytes(self.wallet.pubkey.to_string())
+                pickledTemplate = self.connection.receiveBytes()
+                if not pickledTemplate:
+                    return None
+                start, end = map(int, self.connection.receiveString().split(":"))
+
+                # The template already holds the coinbase of the pool so that all the nodes search the same header
+                if pickledTemplate != template:
+                    template = pickledTemplate
+                    block = pickle.loads(template)
+                    if not block.verifyMerkleRoot():
+                        return None
+
+                if block.mineRange(start, end, miner) is not None:
+                    # Sending the result block to the server
+                    self.connection.sendInt(1)
+                    self.connection.sendObject(block)
+                    if self.connection.receiveInt() == 100:
+                        if self.subscriber is None:
+                            self.database.acceptBlock(block)
+                        return True
+                    return False
 
-    # Function that transform any given string which length is < to the minimum buffer size to the minimum size
-    def toMinSize(self, string):
-        while len(string) < self.minBufferSize:
-            string += " "
-        return string
+                # Reporting the exhausted range, the server cancels us if another node already solved the block
+                self.connection.sendInt(2)
+                if self.connection.receiveInt() == 300:
+                    return False
+        finally:
+            miner.close()
 
     # Function that sends a "close" signal to the server
+    # The push connection is shut down so that the thread listening to it stops
     def close(self):
-        self.socket.send(self.toMinSize("3").encode())
+        self.connection.sendInt(3)
         self.socket.close()
+        if self.subscriber is not None:
+            self.subscriber.closing = True
+            try:
+                self.subscriber.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.subscriber.socket.close()
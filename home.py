@@ -1,7 +1,6 @@
 import datetime
 import json
 import os
-import pickle
 import socket
 import sqlite3
 
@@ -12,6 +11,7 @@ from PyQt5.QtWidgets import *
 from PyQt5.QtWidgets import QScrollArea
 from PyQt5.QtWidgets import QWidget
 
+import init_database
 from classes import Database, Wallet
 from client import Client
 
@@ -26,13 +26,15 @@ class Ui_HomeWindow(object):
         self.centralwidget = QtWidgets.QWidget(HomeWindow)
         self.centralwidget.setObjectName("centralwidget")
 
-        # Connecting to existing database
+        # Connecting to existing database then upgrading its schema if it was created by an older version
         conn = sqlite3.connect('database.db', check_same_thread=False)
+        init_database.require_migration(conn)
 
         # The cursor allow us to execute SQL commands
         c = conn.cursor()
 
-        database = Database(conn, c)
+        # The GUI reads the database from its own connections while the client thread writes the blocks
+        database = Database(conn, c, "database.db", 2)
         wallet = Wallet(database)
 
         minBufferSize = 5
@@ -46,8 +48,11 @@ class Ui_HomeWindow(object):
         # create the client socket
         s = socket.socket()
 
+        # Set to True to mine with the other nodes of the LAN on nonce ranges handed by the server
+        poolMode = False
+
         keysDir = "C:{}\\Keys".format(os.getcwd())
-        self.client = Client(database, minBufferSize, host, port, s, keysDir, wallet)
+        self.client = Client(database, minBufferSize, host, port, s, keysDir, wallet, poolMode=poolMode)
 
         # First frame title
         self.frame1_title = QtWidgets.QLabel(self.centralwidget)
@@ -286,6 +291,12 @@ class Ui_HomeWindow(object):
         self.initVar()
         self.client.start()
 
+        # The new blocks and transactions pushed by the server are applied by the client thread
+        # The signal makes the displayed values refresh on the GUI thread every time one is applied
+        self.notifier = PushNotifier()
+        self.notifier.pushed.connect(self.refresh)
+        self.client.subscribe(lambda kind: self.notifier.pushed.emit())
+
     # Function that initials the node's address, balance, pending coins
     def initVar(self):
         pendingAmount = self.client.wallet.getPendingAmount(self.client.wallet.address)
@@ -313,7 +324,9 @@ class Ui_HomeWindow(object):
 
     # Function that determines whether the call to action is mining or requesting a block
     def switch(self):
-        if self.mineButton.text() == "Mine":
+        if self.client.poolMode:
+            self.poolMine()
+        elif self.mineButton.text() == "Mine":
             self.mine()
         else:
             self.request()
@@ -341,6 +354,18 @@ class Ui_HomeWindow(object):
             .format(str(self.block.id)) + str(self.date()))
         self.refresh()
 
+    # Function that mines in pool mode then displays the outcome
+    def poolMine(self):
+        self.label.setText("- Mining in pool mode. " + str(self.date()))
+        res = self.client.poolMine()
+        if res is None:
+            self.label.setText("- No Blocks Available. " + str(self.date()))
+        elif res:
+            self.label.setText("- You have found the block's hash, the block was added to the chain. " + str(self.date()))
+        else:
+            self.label.setText("- Another node solved the block first. " + str(self.date()))
+        self.refresh()
+
     # Function that refreshes all displayed values
     def refresh(self):
         self.balance.setText(str(self.client.wallet.balance()) + " ISS COINS")
@@ -417,7 +442,7 @@ class Ui_ResWindow(object):
     def retranslateUi(self, MainWindow):
         _translate = QtCore.QCoreApplication.translate
         MainWindow.setWindowTitle(_translate("ResWindow", "Search Result Window"))
-        if self.res.objectDesc.databaseTableName == "Blocks":
+        if self.res.schema.tableName == "Blocks":
             self.blockRes()
         else:
             self.txRes()
@@ -425,22 +450,26 @@ class Ui_ResWindow(object):
     # Function that displays the resulting block
     def blockRes(self):
         self.titleLabel.setText("Search Result in Blocks :")
-        self.res.objectDesc.databaseValues["transactions"] = \
-            pickle.loads(self.res.objectDesc.databaseValues["transactions"])[0].transactionId
-        self.resLabel.setText(json.dumps(self.res.objectDesc.databaseValues, indent=1))
+        values = self.res.schema.values(self.res)
+        values["transactions"] = self.res.transactions[0].transactionId
+        self.resLabel.setText(json.dumps(values, indent=1))
 
     # Function that displays the resulting tx
     def txRes(self):
         self.titleLabel.setText("Search Result in Confirmed and Unconfirmed Transactions :")
-        inputs = pickle.loads(self.res.objectDesc.databaseValues["inputs"])
-        outputs = pickle.loads(self.res.objectDesc.databaseValues["outputs"])
-        self.res.objectDesc.databaseValues["inputs"] = len(inputs)
-        self.res.objectDesc.databaseValues["outputs"] = len(outputs)
-        if self.res.objectDesc.databaseTableName == "Transactions":
-            self.res.objectDesc.databaseValues["status"] = "Confirmed"
+        values = self.res.schema.values(self.res)
+        values["inputs"] = len(self.res.inputs)
+        values["outputs"] = len(self.res.outputs)
+        if self.res.schema.tableName == "Transactions":
+            values["status"] = "Confirmed"
         else:
-            self.res.objectDesc.databaseValues["status"] = "Unconfirmed"
-        self.resLabel.setText(json.dumps(self.res.objectDesc.databaseValues, indent=1))
+            values["status"] = "Unconfirmed"
+        self.resLabel.setText(json.dumps(values, indent=1))
+
+
+# class carrying the pushes applied by the client thread to the GUI thread
+class PushNotifier(QtCore.QObject):
+    pushed = QtCore.pyqtSignal()
 
 
 # class for scrollable label
@@ -1,5 +1,7 @@
+import pickle
 import sqlite3
 from sqlite3 import Error
+from classes import Codec, Database
 
 
 def create_connection(db_file):
@@ -21,6 +23,139 @@ def create_table(conn, create_table_sql):
         print(e)
 
 
+# Columns holding the encoded attributes of the objects of every table
+encoded_columns = {"Blocks": ["transactions"],
+                   "Transactions": ["inputs", "outputs"],
+                   "Unconfirmed_Transactions": ["inputs", "outputs"]}
+
+
+# Returns the value encoded with the Codec, values pickled by older versions are decoded first
+def recode(value):
+    if Codec.isEncoded(value):
+        return value
+    value = pickle.loads(value)
+    # Rows synced by older clients were pickled twice
+    while isinstance(value, bytes):
+        value = pickle.loads(value)
+    return Codec.encode(value)
+
+
+# Rewrites the pickled attributes of every row with the Codec, a few hundred rows at a time
+def encode_pickled_rows(c):
+    for table, columns in encoded_columns.items():
+        last_id = -1
+        while True:
+            c.execute("SELECT id, {} FROM {} WHERE id > ? ORDER BY id LIMIT 500".format(", ".join(columns), table),
+                      (last_id,))
+            rows = c.fetchall()
+            if not rows:
+                break
+            for row in rows:
+                c.execute("UPDATE {} SET {} WHERE id = ?".format(table, ", ".join(col + " = ?" for col in columns)),
+                          [recode(value) for value in row[1:]] + [row[0]])
+            last_id = rows[-1][0]
+
+
+# Stores the inputs and outputs of the transactions already in the database in the Tx_Inputs and Tx_Outputs tables
+# The unconfirmed transactions are stored first so that a transaction in both tables ends up confirmed
+def index_transactions(c):
+    database = Database(c.connection, c)
+    for table in ["Unconfirmed_Transactions", "Transactions"]:
+        transactions = []
+        for tx in database.iterObjects(table):
+            transactions.append(tx)
+            if len(transactions) == 500:
+                database.indexTransactions(table, transactions)
+                transactions = []
+        database.indexTransactions(table, transactions)
+
+
+# Migrations that upgrade an existing database in place, they are applied in order
+# The schema version of a database is the number of migrations applied to it, stored in PRAGMA user_version
+# A migration is a list of steps, a step is an SQL statement or a function called with the cursor
+migrations = [
+    # Version 1: indexes on the columns used by the most frequent lookups
+    ["CREATE INDEX IF NOT EXISTS UTXO_address ON UTXO (address)",
+     "CREATE INDEX IF NOT EXISTS UTXO_lockingScript ON UTXO (lockingScript)",
+     "CREATE INDEX IF NOT EXISTS Transactions_transactionId ON Transactions (transactionId)",
+     "CREATE INDEX IF NOT EXISTS Unconfirmed_Transactions_transactionId "
+     "ON Unconfirmed_Transactions (transactionId)"],
+    # Version 2: the pickled attributes are rewritten with the binary Codec
+    [encode_pickled_rows],
+    # Version 3: the inputs and outputs of the transactions are also stored one per row
+    # so that the amounts of an address are summed in SQL
+    ["""CREATE TABLE IF NOT EXISTS Tx_Inputs (
+            transactionId text NOT NULL,
+            inputIndex integer NOT NULL,
+            address text NOT NULL,
+            value real NOT NULL,
+            prevTxId text NOT NULL,
+            scriptHash blob NOT NULL,
+            confirmed integer NOT NULL,
+            PRIMARY KEY (transactionId, inputIndex)
+        )""",
+     """CREATE TABLE IF NOT EXISTS Tx_Outputs (
+            transactionId text NOT NULL,
+            outputIndex integer NOT NULL,
+            address text NOT NULL,
+            value real NOT NULL,
+            scriptHash blob NOT NULL,
+            confirmed integer NOT NULL,
+            PRIMARY KEY (transactionId, outputIndex)
+        )""",
+     "CREATE INDEX IF NOT EXISTS Tx_Inputs_address ON Tx_Inputs (address, confirmed)",
+     "CREATE INDEX IF NOT EXISTS Tx_Inputs_outpoint ON Tx_Inputs (prevTxId, scriptHash)",
+     "CREATE INDEX IF NOT EXISTS Tx_Outputs_address ON Tx_Outputs (address, confirmed)",
+     index_transactions],
+    # Version 4: the server logs the changes of the UTXO and Unconfirmed_Transactions tables with a sequence number
+    # and the nodes remember the last change they applied so that they only download the newer ones
+    ["""CREATE TABLE IF NOT EXISTS Change_Log (
+            seq integer PRIMARY KEY AUTOINCREMENT,
+            tableName text NOT NULL,
+            event text NOT NULL,
+            objectId integer,
+            distinctValue blob NOT NULL
+        )""",
+     """CREATE TABLE IF NOT EXISTS Sync_State (
+            name text PRIMARY KEY,
+            value text NOT NULL
+        )"""],
+]
+
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+# Applies the migrations the database is missing, each one in its own transaction with the new schema version
+def migrate(conn):
+    version = get_schema_version(conn)
+    for i in range(version, len(migrations)):
+        c = conn.cursor()
+        try:
+            c.execute("BEGIN")
+            for step in migrations[i]:
+                if callable(step):
+                    step(c)
+                else:
+                    c.execute(step)
+            c.execute("PRAGMA user_version = {}".format(i + 1))
+            conn.commit()
+        # Whatever fails, the migration is rolled back so that the database is left at its previous version
+        except Exception as e:
+            conn.rollback()
+            print(e)
+            return
+    return get_schema_version(conn)
+
+
+# Applies the migrations the database is missing, the program is stopped if one of them failed
+# since every query on the tables of the later migrations would fail
+def require_migration(conn):
+    if migrate(conn) != len(migrations):
+        raise RuntimeError("The database could not be upgraded to schema version {}".format(len(migrations)))
+
+
 def main(database):
     sql_create_blocks_table = """CREATE TABLE IF NOT EXISTS Blocks (
                                         id integer PRIMARY KEY,
@@ -71,6 +206,8 @@ def main(database):
         create_table(conn, sql_create_transactions_table)
         create_table(conn, sql_create_unconfirmed_transactions_table)
         create_table(conn, sql_create_UTXO_table)
+        # upgrade the schema of the database
+        require_migration(conn)
     else:
         print("Error! cannot create the database connection.")
 
@@ -0,0 +1,331 @@
+import asyncio
+import pickle
+import struct
+import zlib
+
+# Highest version of the protocol spoken by this code, the node and the server agree on the highest version both speak
+# The node logs in like in version 1 but prefixes the length of its address with "+": a server speaking version 1
+# reads it as the length, a newer server answers with its highest version (see Connection.login)
+# Version 1 sends the lengths and the integers as strings padded to minBufferSize characters
+# Version 2 sends every message in a frame: a header packing the message type and the length of the payload
+protocolVersion = 2
+# Minimum data size to be sent/received in version 1
+minBufferSize = 5
+# Header of a version 2 frame: message type and length of the payload
+frameHeader = struct.Struct("<BI")
+# Payload of an integer message
+intFormat = struct.Struct("<q")
+# Message types of version 2
+# A chunk holds a batch of rows of the bulk synchronization, pickled then compressed, an empty chunk ends the batches
+# A push holds a pickled change the server sends on its own to the nodes that subscribed
+INT, BYTES, CHUNK, PUSH = 1, 2, 3, 4
+# Largest payload accepted in a frame, a bigger length means the stream is corrupted
+maxFrameSize = 256 * 1024 * 1024
+# Payloads up to this size are sent in the same call as their header
+smallFrameSize = 64 * 1024
+
+
+# Function that transform any given string which length is < to the minimum buffer size to the minimum size
+def toMinSize(string):
+    while len(string) < minBufferSize:
+        string += " "
+    return string
+
+
+# Function that returns the version named by the designed handshake token ("v2   "), None if it isn't a token
+def parseVersion(token):
+    try:
+        token = bytes(token).decode().strip()
+        if not token.startswith("v"):
+            return None
+        return int(token[1:])
+    except (UnicodeDecodeError, ValueError):
+        return None
+
+
+# Function that returns the header and the payload of a frame, small payloads are joined to their header
+def frameParts(type, payload):
+    header = frameHeader.pack(type, len(payload))
+    if len(payload) <= smallFrameSize:
+        return [header + payload]
+    return [header, memoryview(payload)]
+
+
+# Function that returns the payload of a chunk holding the designed rows
+def encodeChunk(rows):
+    return zlib.compress(pickle.dumps(rows))
+
+
+# Function that returns the rows held by the payload of a chunk, an empty list for the chunk ending the batches
+# and None if it's not valid
+def decodeChunk(payload):
+    if payload is None:
+        return None
+    if not payload:
+        return []
+    try:
+        return pickle.loads(zlib.decompress(payload))
+    except Exception:
+        return None
+
+
+# Function that transforms the designed received data to the designed type, None if it's not valid
+def decodeMessage(data, type):
+    if data is None:
+        return None
+    try:
+        if type == "Object":
+            return pickle.loads(data)
+        if type == "String":
+            return bytes(data).decode().strip()
+    except Exception:
+        return None
+    return data
+
+
+# Connection Class that sends and receives the messages of the protocol on a blocking socket (node side)
+# The received values are None if the connection was lost or if the data is invalid
+class Connection:
+    def __init__(self, sock, version=1):
+        self.sock = sock
+        self.version = version
+        # Bytes already received that the next message starts with
+        self.buffered = b""
+
+    # Function that logs the node in with its address and agrees on the version of the protocol with the server
+    # A server speaking a newer version answers the "+" prefixed length with its highest version, the node replies
+    # with the version it chose, a server that only speaks version 1 starts synchronizing the node right away so
+    # what was received is kept as the start of its first message
+    # Returns the version agreed on
+    def login(self, address):
+        data = address.encode()
+        self.sock.sendall(toMinSize("+" + str(len(data))).encode() + data)
+        reply = self.receiveExact(minBufferSize)
+        version = parseVersion(reply) if reply is not None else None
+        if version is None:
+            self.buffered = bytes(reply or b"")
+            self.version = 1
+            return self.version
+        self.version = min(version, protocolVersion)
+        self.sock.sendall(toMinSize("v{}".format(self.version)).encode())
+        return self.version
+
+    def sendInt(self, value):
+        if self.version >= 2:
+            self.sendFrame(INT, intFormat.pack(value))
+        else:
+            self.sock.sendall(toMinSize(str(value)).encode())
+
+    def sendBytes(self, data):
+        if self.version >= 2:
+            self.sendFrame(BYTES, data)
+        else:
+            self.sock.sendall(toMinSize(str(len(data))).encode())
+            if data:
+                self.sock.sendall(memoryview(data))
+
+    def sendObject(self, object):
+        self.sendBytes(pickle.dumps(object))
+
+    def sendString(self, string):
+        self.sendBytes(string.encode())
+
+    # Function that sends a chunk encoded by encodeChunk (version 2 only)
+    def sendChunk(self, payload):
+        self.sendFrame(CHUNK, payload)
+
+    # Function that sends a pickled push (version 2 only)
+    def sendPush(self, payload):
+        self.sendFrame(PUSH, payload)
+
+    # Function that sends a version 2 frame
+    def sendFrame(self, type, payload):
+        for part in frameParts(type, payload):
+            self.sock.sendall(part)
+
+    def receiveInt(self):
+        try:
+            if self.version >= 2:
+                payload = self.receiveFrame(INT)
+                return None if payload is None else intFormat.unpack(payload)[0]
+            data = self.receiveExact(minBufferSize)
+            return None if data is None else int(data)
+        except (OSError, ValueError, struct.error):
+            return None
+
+    def receiveBytes(self):
+        if self.version >= 2:
+            return self.receiveFrame(BYTES)
+        length = self.receiveInt()
+        if length is None:
+            return None
+        return self.receiveExact(length)
+
+    def receiveObject(self):
+        return decodeMessage(self.receiveBytes(), "Object")
+
+    def receiveString(self):
+        return decodeMessage(self.receiveBytes(), "String")
+
+    # Function that receives a chunk and returns its rows, see decodeChunk
+    def receiveChunk(self):
+        return decodeChunk(self.receiveFrame(CHUNK))
+
+    # Function that waits for the next push and returns it
+    def receivePush(self):
+        return decodeMessage(self.receiveFrame(PUSH), "Object")
+
+    # Function that receives a version 2 frame of the designed type and returns its payload
+    def receiveFrame(self, type):
+        header = self.receiveExact(frameHeader.size)
+        if header is None:
+            return None
+        frameType, length = frameHeader.unpack(header)
+        if frameType != type or length > maxFrameSize:
+            return None
+        return self.receiveExact(length)
+
+    # Function that receives exactly the designed number of bytes in a buffer allocated once
+    # recv may return less than what was asked for, it's called again until the buffer is full
+    def receiveExact(self, length):
+        buffer = bytearray(length)
+        view = memoryview(buffer)
+        received = min(length, len(self.buffered))
+        buffer[:received] = self.buffered[:received]
+        self.buffered = self.buffered[received:]
+        try:
+            while received < length:
+                count = self.sock.recv_into(view[received:])
+                if count == 0:
+                    return None
+                received += count
+        except OSError:
+            return None
+        return buffer
+
+
+# AsyncConnection Class that sends and receives the messages of the protocol on asyncio streams (server side)
+# The received values are None if the connection was lost or if the data is invalid
+class AsyncConnection:
+    def __init__(self, reader, writer, version=1):
+        self.reader = reader
+        self.writer = writer
+        self.version = version
+
+    # Function that reads the login of a node: the length of its address then its address (see Connection.login)
+    # A "+" prefixed length asks for a newer version, the node is answered with the highest version of the server
+    # then replies with the version it chose
+    # Returns the address of the node, None if the login is invalid
+    async def acceptLogin(self):
+        token = await self.receiveExact(minBufferSize)
+        try:
+            length = int(token)
+        except (TypeError, ValueError):
+            return None
+        address = await self.receiveExact(length) if length >= 0 else None
+        if address is None:
+            return None
+        if token.strip().startswith(b"+"):
+            self.writer.write(toMinSize("v{}".format(protocolVersion)).encode())
+            await self.writer.drain()
+            reply = await self.receiveExact(minBufferSize)
+            version = parseVersion(reply) if reply is not None else None
+            if version is None or not 1 <= version <= protocolVersion:
+                return None
+            self.version = version
+        try:
+            return address.decode().strip()
+        except UnicodeDecodeError:
+            return None
+
+    async def sendInt(self, value):
+        if self.version >= 2:
+            await self.sendFrame(INT, intFormat.pack(value))
+        else:
+            self.writer.write(toMinSize(str(value)).encode())
+            await self.writer.drain()
+
+    async def sendBytes(self, data):
+        if self.version >= 2:
+            await self.sendFrame(BYTES, data)
+        else:
+            self.writer.write(toMinSize(str(len(data))).encode())
+            if data:
+                self.writer.write(memoryview(data))
+            await self.writer.drain()
+
+    async def sendObject(self, object):
+        await self.sendBytes(pickle.dumps(object))
+
+    async def sendString(self, string):
+        await self.sendBytes(string.encode())
+
+    # Function that sends a chunk encoded by encodeChunk (version 2 only)
+    async def sendChunk(self, payload):
+        await self.sendFrame(CHUNK, payload)
+
+    # Function that sends a pickled push (version 2 only)
+    async def sendPush(self, payload):
+        await self.sendFrame(PUSH, payload)
+
+    # Function that sends a version 2 frame
+    async def sendFrame(self, type, payload):
+        for part in frameParts(type, payload):
+            self.writer.write(part)
+        await self.writer.drain()
+
+    # The nodes of version 1 send their last ids unpadded, they are read with padded=False
+    async def receiveInt(self, padded=True):
+        try:
+            if self.version >= 2:
+                payload = await self.receiveFrame(INT)
+                return None if payload is None else intFormat.unpack(payload)[0]
+            if not padded:
+                return int(await self.reader.read(minBufferSize))
+            data = await self.receiveExact(minBufferSize)
+            return None if data is None else int(data)
+        except (OSError, ValueError, struct.error):
+            return None
+
+    async def receiveBytes(self):
+        if self.version >= 2:
+            return await self.receiveFrame(BYTES)
+        length = await self.receiveInt()
+        if length is None:
+            return None
+        return await self.receiveExact(length)
+
+    async def receiveObject(self):
+        return decodeMessage(await self.receiveBytes(), "Object")
+
+    async def receiveString(self):
+        return decodeMessage(await self.receiveBytes(), "String")
+
+    # Function that receives a chunk and returns its rows, see decodeChunk
+    async def receiveChunk(self):
+        return decodeChunk(await self.receiveFrame(CHUNK))
+
+    # Function that waits for the next push and returns it
+    async def receivePush(self):
+        return decodeMessage(await self.receiveFrame(PUSH), "Object")
+
+    # Function that receives a version 2 frame of the designed type and returns its payload
+    async def receiveFrame(self, type):
+        header = await self.receiveExact(frameHeader.size)
+        if header is None:
+            return None
+        frameType, length = frameHeader.unpack(header)
+        if frameType != type or length > maxFrameSize:
+            return None
+        return await self.receiveExact(length)
+
+    # Function that receives exactly the designed number of bytes, None if the connection was lost before
+    async def receiveExact(self, length):
+        try:
+            return await self.reader.readexactly(length)
+        except (OSError, asyncio.IncompleteReadError):
+            return None
+
+    # Function that closes the connection
+    def close(self):
+        self.writer.close()
@@ -1,238 +1,808 @@
-import os
+import asyncio
+import heapq
+import math
 import pickle
 import socket
 import sqlite3
 import time
-from ecdsa import VerifyingKey, SECP256k1
+from concurrent.futures import ThreadPoolExecutor
+from ecdsa import SECP256k1, VerifyingKey
+from ecdsa.errors import MalformedPointError
 import init_database
-from classes import Block, Database, Transaction
+import KeysGeneration
+from classes import Block, Database, Output, SignatureCache, SignatureVerifier, Transaction, UtxoSet, \
+    createLockingScript, outpoint
+from protocol import AsyncConnection, encodeChunk
 
 # local host IP address
 serverHost = socket.gethostbyname(socket.gethostname())
 # Port to listen on
 serverPort = 50000
-# Minimum data size to be sent/received
-minBufferSize = 5
-# Seperator used by both parties to identify data
-SEPERATOR = "<SEPERATOR>"
+# Maximum number of pending transactions packed in a block
+maxBlockTransactions = 50
+# Maximum size in bytes of the pending transactions held in memory
+maxMempoolSize = 16 * 1024 * 1024
+# Maximum number of valid signatures remembered by the server
+maxSignatureCacheSize = 100000
+# Number of nonce ranges the hashes expected to solve a block are split into in pool mode
+poolRangesPerBlock = 16
+# Minimum number of nonces handed to a node every time it asks for work in pool mode
+minPoolRangeSize = 1024
+# Number of read-only connections to the database
+readerConnections = 4
+# File the UTXO set is saved to so that it doesn't have to be read from the database at the next start
+utxoSnapshotPath = "utxo.snapshot"
+# Number of blocks between two snapshots of the UTXO set
+snapshotInterval = 10
+# Number of rows sent in every chunk of the bulk synchronization of the Blocks and Transactions tables
+syncChunkRows = 500
+# Number of changes of the UTXO and Unconfirmed_Transactions tables kept for the nodes synchronizing incrementally
+maxChangeLogSize = 100000
+# Number of templates of the current chain tip remembered to check the blocks mined on them
+maxServedTemplates = 16
+# Number of connections waiting to be accepted
+listenBacklog = 100
+# Number of pushes waiting to be sent to a subscriber before it's dropped for falling too far behind
+maxPushBacklog = 1000
+
+
+# Mempool Class that holds the pending transactions in memory
+# The Unconfirmed_Transactions table is only written to so that the pending transactions survive a restart
+class Mempool:
+    def __init__(self, database, maxSize):
+        self.database = database
+        self.maxSize = maxSize
+        # Pending transactions indexed by their transactionId
+        self.txs = {}
+        # Heap entry (fee rate, sequence, transactionId) of every pending transaction
+        self.entries = {}
+        # Heap of the entries, the lowest fee rate is on top, removed transactions are skipped lazily
+        self.heap = []
+        self.sequence = 0
+        # Size in bytes of every pending transaction and of all of them
+        self.sizes = {}
+        self.size = 0
+        # Outpoints spent by the pending transactions mapped to the transactionId that spends them
+        self.spent = {}
+        # Utxos spent by every pending transaction, they are given back if it's evicted
+        self.utxos = {}
+        # Incremented every time a transaction enters or leaves the mempool
+        self.version = 0
+        for tx in database.iterObjects("Unconfirmed_Transactions"):
+            self.track(tx, self.restoreUtxos(tx))
+        self.evict()
+
+    def __len__(self):
+        return len(self.txs)
+
+    def __contains__(self, transactionId):
+        return transactionId in self.txs
+
+    # Function that rebuilds the utxos spent by a pending transaction loaded from the database
+    # Their address and value are read from the outputs they were, they get new ids when they're given back
+    def restoreUtxos(self, tx):
+        outputs = self.database.getOutputs([input.prevTxId for input in tx.inputs])
+        utxos = []
+        for input in tx.inputs:
+            output = outputs.get(outpoint(input.prevTxId, input.lockingScript))
+            if output is not None:
+                utxos.append(Output(None, output[1], output[0], input.prevTxId, input.lockingScript))
+        return utxos
+
+    # Function that indexes the designed transaction and the utxos it spends in memory
+    def track(self, tx, utxos):
+        size = len(pickle.dumps(tx))
+        self.sequence += 1
+        entry = (tx.fees / size, self.sequence, tx.transactionId)
+        self.txs[tx.transactionId] = tx
+        self.utxos[tx.transactionId] = utxos
+        self.entries[tx.transactionId] = entry
+        self.sizes[tx.transactionId] = size
+        self.size += size
+        heapq.heappush(self.heap, entry)
+        for input in tx.inputs:
+            self.spent[outpoint(input.prevTxId, input.lockingScript)] = tx.transactionId
+        self.version += 1
+
+    # Function that removes the designed transaction from memory, the heap entry is dropped once it reaches the top
+    # The heap is rebuilt from the pending transactions once it holds more removed entries than pending ones
+    def discard(self, transactionId):
+        tx = self.txs.pop(transactionId, None)
+        if tx is None:
+            return None
+        del self.entries[transactionId]
+        del self.utxos[transactionId]
+        self.size -= self.sizes.pop(transactionId)
+        for input in tx.inputs:
+            self.spent.pop(outpoint(input.prevTxId, input.lockingScript), None)
+        if len(self.heap) > 2 * len(self.entries):
+            self.heap = list(self.entries.values())
+            heapq.heapify(self.heap)
+        self.version += 1
+        return tx
+
+    # Function that checks if the designed transaction spends an outpoint already spent by a pending transaction
+    def conflicts(self, tx):
+        for input in tx.inputs:
+            if outpoint(input.prevTxId, input.lockingScript) in self.spent:
+                return True
+        return False
+
+    # Function that adds the designed transaction spending the designed utxos to the mempool and to the
+    # Unconfirmed_Transactions table
+    # Returns False if the transaction was evicted right away because the mempool is full of higher fee transactions
+    def add(self, tx, utxos):
+        self.database.addObject(tx)
+        self.track(tx, utxos)
+        self.evict()
+        return tx.transactionId in self.txs
+
+    # Function that evicts the lowest fee rate transactions until the mempool fits in its maximum size
+    # The utxos spent by an evicted transaction are given back to the UTXO table, with their ids unless
+    # other rows took them since, then a copy gets a new id so that the utxo in a snapshot being written is unchanged
+    def evict(self):
+        while self.size > self.maxSize and self.heap:
+            entry = heapq.heappop(self.heap)
+            if self.entries.get(entry[2]) != entry:
+                continue
+            utxos = self.utxos[entry[2]]
+            tx = self.discard(entry[2])
+            with self.database.unitOfWork():
+                self.database.removeObject(tx)
+                for utxo in utxos:
+                    if utxo.id is not None and self.database.getRawObjectById("UTXO", utxo.id) is None:
+                        self.database.insertObject(utxo, True)
+                    else:
+                        self.database.insertObject(
+                            Output(None, utxo.value, utxo.address, utxo.transactionId, utxo.lockingScript))
+
+    # Function that returns the pending transactions with the highest fee rates, at most limit of them
+    def select(self, limit):
+        entries = heapq.nlargest(limit, self.entries.values(), key=lambda e: (e[0], -e[1]))
+        return [self.txs[entry[2]] for entry in entries]
+
+
+# BlockTemplateCache Class that keeps the serialized template of the next block ready to be sent
+# The template is only rebuilt when the chain tip or the mempool changed since it was built
+# The templates built on the current chain tip are remembered by timestamp, a mined block must be one of them
+class BlockTemplateCache:
+    def __init__(self, database, mempool):
+        self.database = database
+        self.mempool = mempool
+        # (last block id, mempool version) the cached template was built for
+        self.key = None
+        self.block = None
+        self.template = None
+        # Templates built on the current chain tip by timestamp, the oldest first
+        self.served = {}
+
+    # Function that returns the serialized template of the next block, None if there is no block to mine
+    def get(self):
+        key = (self.database.getLastObjectId("Blocks"), self.mempool.version)
+        if key != self.key:
+            if self.key is None or key[0] != self.key[0]:
+                self.served = {}
+            block = self.build(key[0])
+            self.template = pickle.dumps(block) if block is not None else None
+            self.key = key
+            self.block = block
+            if block is not None:
+                self.served[block.timestamp] = block
+                if len(self.served) > maxServedTemplates:
+                    del self.served[next(iter(self.served))]
+        return self.template
+
+    # Function that returns the template the designed block was mined on, None if it wasn't served for the current tip
+    def find(self, block):
+        self.get()
+        template = self.served.get(block.timestamp)
+        if template is None or template.id != block.id:
+            return None
+        return template
+
+    # Function that builds the next block: the genesis block or a block packing the highest fee pending transactions
+    def build(self, lastId):
+        if lastId == 0:
+            block = Block(0, [], time.time(), "", "", 50, 0, 2)
+        elif len(self.mempool) > 0:
+            prevHash = self.database.getObjectById("Blocks", lastId).hash
+            block = Block(lastId + 1, [confirmedCopy(tx) for tx in self.mempool.select(maxBlockTransactions)],
+                          time.time(), prevHash, "0", 50, 0, 2)
+        else:
+            return None
+        block.finalReward()
+        block.updateMerkleRoot()
+        return block
+
+
+# Function that returns the designed pending transaction as a transaction of the Transactions table
+def confirmedCopy(tx):
+    return Transaction(tx.id, tx.type, tx.inputs, tx.outputs, tx.timestamp, tx.transactionId, tx.fees)
+
+
+# NoncePool Class that hands disjoint nonce ranges of the current block template to the nodes mining in pool mode
+# so that their hashrates add up instead of repeating each other's work
+# The members all search the same block: the template followed by a coinbase built by the server that splits the
+# reward between them, the pool template is built again when a node joins or leaves the pool
+# A member that asked for no range while the last two pool templates were mined is dropped from the next one
+class NoncePool:
+    def __init__(self, rangesPerBlock, minRangeSize):
+        self.rangesPerBlock = rangesPerBlock
+        self.minRangeSize = minRangeSize
+        # Key of the template the pool template was built on, see BlockTemplateCache
+        self.key = None
+        # Incremented every time the pool template is built, the ranges of the previous ones are dropped
+        self.generation = 0
+        # Serialized pool template and number of nonces of its ranges
+        self.template = None
+        self.rangeSize = minRangeSize
+        # First nonce that was not handed yet
+        self.nextNonce = 0
+        # Range currently assigned to every session
+        self.assignments = {}
+        # (wallet address, public key) every session mining in the pool is paid to
+        self.members = {}
+        # Sessions that asked for a range of the current pool template and of the previous one
+        self.active = set()
+        self.previous = set()
+
+    # Function that adds the designed session to the pool members, paid to the designed public key
+    # Returns False if the public key isn't the one of the wallet the node logged in with
+    def join(self, session, pubkey):
+        if self.members.get(session) == (session.address, pubkey):
+            return True
+        try:
+            address = KeysGeneration.pubkeyToAddr(VerifyingKey.from_string(pubkey, curve=SECP256k1))
+        except MalformedPointError:
+            return False
+        if address != session.address:
+            return False
+        self.members[session] = (address, pubkey)
+        self.key = None
+        return True
+
+    # Function that removes the designed session from the pool members
+    def leave(self, session):
+        self.assignments.pop(session, None)
+        self.active.discard(session)
+        self.previous.discard(session)
+        if self.members.pop(session, None) is not None:
+            self.key = None
+
+    # Function that returns the pool template of the designed template, its generation and the next free nonce
+    # range of it for the designed session
+    def assign(self, key, block, session):
+        if key != self.key:
+            self.key = key
+            self.generation += 1
+            # The idle members are dropped, they join again with their next request
+            working = self.active | self.previous | {session}
+            self.members = {member: payee for member, payee in self.members.items() if member in working}
+            self.previous, self.active = self.active, set()
+            self.template = pickle.dumps(poolBlock(block, list(self.members.values())))
+            # A range is a fraction of the hashes expected to solve the block so the members report back often
+            # and stop searching soon after another node solved it
+            self.rangeSize = max(self.minRangeSize, 16 ** block.difficulty // self.rangesPerBlock)
+            self.nextNonce = 0
+            self.assignments = {}
+        nonceRange = (self.nextNonce, self.nextNonce + self.rangeSize)
+        self.nextNonce += self.rangeSize
+        self.assignments[session] = nonceRange
+        self.active.add(session)
+        return self.template, self.generation, nonceRange
+
+    # Function that records that the designed session searched its whole range without finding a valid hash
+    # Returns True if the range belongs to the current pool template
+    def report(self, generation, session):
+        nonceRange = self.assignments.pop(session, None)
+        return generation == self.generation and nonceRange is not None
+
+
+# Function that returns the designed template followed by a coinbase splitting its reward between the designed
+# (wallet address, public key) pairs
+def poolBlock(template, members):
+    coinbase = Transaction(None, 1)
+    coinbase.computeTxId()
+    share = template.reward / len(members)
+    for address, pubkey in members:
+        coinbase.addOutput(createLockingScript(pubkey, Output(None, share, address, coinbase.transactionId, None)))
+    coinbase.calculateFees()
+    block = Block(template.id, template.transactions + [coinbase], template.timestamp, template.previousHash,
+                  template.hash, template.reward, template.nonce, template.difficulty)
+    block.updateMerkleRoot()
+    return block
+
+
+# Publisher Class that pushes the new blocks, the confirmed transactions and the changes of the mempool and of the
+# UTXO set to the nodes that subscribed, as soon as they are committed
+class Publisher:
+    def __init__(self, database, maxBacklog):
+        self.database = database
+        self.maxBacklog = maxBacklog
+        # Event loop serving the subscribers, set once the server is started
+        self.loop = None
+        # Queue of the pushes waiting to be sent of every subscriber
+        self.subscribers = set()
+        # Sequence number of the last change of the change log that was pushed
+        self.publishedSeq = database.getChangeLogState()[2]
+        database.addListener(self.update)
+
+    # Function that returns the queue the pushes of a new subscriber are put in
+    def subscribe(self):
+        queue = asyncio.Queue()
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self.subscribers.discard(queue)
+
+    # Function called on the database thread once a unit of work is committed (see Database.addListener)
+    # The new rows of the Blocks and Transactions tables are pushed as they are, the changes of the
+    # Unconfirmed_Transactions and UTXO tables are read from the change log like the incremental synchronization
+    def update(self, event, tableName, objects):
+        if self.loop is None:
+            return
+        if tableName in ["Blocks", "Transactions"]:
+            if event != "add":
+                return
+            ids = [object.id for object in objects]
+            message = ("rows", tableName, self.database.getRawObjectsInRange(tableName, min(ids), max(ids)))
+        elif tableName in Database.changeLogTables:
+            epoch, firstSeq, lastSeq = self.database.getChangeLogState()
+            # The changes of the other tables of the unit of work were already pushed with the first one
+            if lastSeq <= self.publishedSeq:
+                return
+            message = ("changes", epoch, lastSeq, self.database.getChanges(self.publishedSeq, lastSeq))
+            self.publishedSeq = lastSeq
+        else:
+            return
+        # The push is serialized once for all the subscribers
+        self.loop.call_soon_threadsafe(self.publish, pickle.dumps(message))
 
-# Creates a database if non-existent
-if not os.path.exists("database.db"):
-    init_database.main("database.db")
+    # Function that queues the designed push for every subscriber
+    # A subscriber too far behind is dropped, it synchronizes again when it subscribes again
+    def publish(self, payload):
+        for queue in list(self.subscribers):
+            if queue.qsize() >= self.maxBacklog:
+                self.unsubscribe(queue)
+                queue.put_nowait(None)
+            else:
+                queue.put_nowait(payload)
 
-# Connecting to existing database
-conn = sqlite3.connect('database.db', check_same_thread=False)
 
-# The cursor allow us to execute SQL commands
-c = conn.cursor()
+# NodeSession Class that holds the connection of a node and what the server knows about it
+class NodeSession:
+    def __init__(self, reader, writer):
+        # Messages exchanged with the node, in the version of the protocol agreed on at login
+        self.connection = AsyncConnection(reader, writer)
+        # Ip address and port of the node
+        self.peer = writer.get_extra_info("peername")
+        # Wallet address the node logged in with
+        self.address = None
 
-# Creating a Database instance
-database = Database(conn, c)
 
-# create the server socket
-# The arguments passed to socket() specify the address family and socket type.
-# AF_INET is the Internet address family for IPv4.
-# SOCK_STREAM is the socket type for TCP, the protocol that will be used to transport our messages in the network.
-s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+# Function that runs the designed function on the database thread without blocking the event loop
+# The writes and the in-memory state of the server (mempool, templates, nonce ranges, UTXO set) are only
+# touched from that thread, one call at a time, so the nodes never see them half updated
+def onDatabase(function, *args):
+    return asyncio.get_running_loop().run_in_executor(databaseExecutor, function, *args)
 
-# bind the socket to our local ip address on port 5001
-# bind() is used to associate the socket with a specific network interface and port number
-s.bind((serverHost, serverPort))
 
-# enabling our server to accept connections
-# 5 here is the number of unaccepted connections that
-# the system will allow before refusing new connections
-s.listen(5)
-print(f"[*] Listening as {serverHost}:{serverPort}")
+# Function that runs the designed query on one of the reader threads, it's read from the read-only connections
+# so it doesn't wait for the database thread
+def onReader(function, *args):
+    return asyncio.get_running_loop().run_in_executor(readerExecutor, function, *args)
 
 
 # Receive the node's wallet address
-def nodeLogin():
-    length = receive(minBufferSize, "Int")
-    print(receive(length, "String"))
+# A node speaking a newer version of the protocol asks for it with its address, see AsyncConnection.acceptLogin
+async def nodeLogin(session):
+    session.address = await session.connection.acceptLogin()
+    print(session.address)
+    return session.address is not None
 
 
 # Update the node's database if needed
-def updateDatabase():
-    # We got 4 tables in our database
-    tableNames = ["Blocks", "Transactions", "Unconfirmed_Transactions", "UTXO"]
-    for tableName in tableNames:
-        # For the Blocks and Transactions tables it's enough to check what index is last in the node's database
-        # Because no block or transaction will ever be deleted
-        if tableName == "Blocks" or tableName == "Transactions":
-            lastId = database.getLastObjectId(tableName)
-            nodeSocket.send(toMinSize(toMinSize(str(lastId))).encode())
-            m = receive(minBufferSize, "Int")
-            for i in range(m + 1, lastId + 1):
-                rawData = database.getRawObjectById(tableName, i)
-                if rawData:
-                    pickledObject = pickle.dumps(rawData)
-                    length = len(pickledObject)
-                    nodeSocket.send(toMinSize(str(length)).encode())
-                    nodeSocket.send(pickledObject)
-
-        # For the other tables we need to check what indexes are present in the node's and server's database
-        # Then we compare the two resulting sets of indexes to see which objects are to be added/deleted
-        else:
-            set1 = pickle.dumps(set(database.getObjectIdList(tableName)))
-            length = toMinSize(str(len(set1))).encode()
-            nodeSocket.send(length)
-            nodeSocket.send(set1)
+async def updateDatabase(session):
+    # For the Blocks and Transactions tables it's enough to check what index is last in the node's database
+    # Because no block or transaction will ever be deleted
+    # The last id is read from the committed rows so that every row up to it can be sent while a block is added
+    for tableName in ["Blocks", "Transactions"]:
+        lastId = await onReader(database.getCommittedLastObjectId, tableName)
+        await session.connection.sendInt(lastId)
+        m = await session.connection.receiveInt(padded=False)
+        if m is None:
+            return False
+        # A node speaking version 2 of the protocol receives the rows in compressed chunks
+        if session.connection.version >= 2:
+            await sendChunks(session, tableName, m + 1, lastId)
+            continue
+        for i in range(m + 1, lastId + 1):
+            rawData = await onReader(database.getRawObjectById, tableName, i)
+            if rawData:
+                await session.connection.sendObject(rawData)
+
+    # The Unconfirmed_Transactions and UTXO tables change all the time, a node speaking version 2 of the protocol
+    # only downloads their changes since its last synchronization
+    if session.connection.version >= 2:
+        return await syncChanges(session)
+    for tableName in ["Unconfirmed_Transactions", "UTXO"]:
+        if not await syncIds(session, tableName):
+            return False
+    return True
+
+
+# Function that sends the rows of the designed table between the two designed ids in chunks of syncChunkRows rows
+# The next chunk is read and compressed by a reader thread while the current one is being sent
+# An empty chunk tells the node that all the rows were sent
+async def sendChunks(session, tableName, firstId, lastId):
+    ranges = [(start, min(start + syncChunkRows - 1, lastId)) for start in range(firstId, lastId + 1, syncChunkRows)]
+    nextChunk = onReader(readChunk, tableName, *ranges[0]) if ranges else None
+    for i in range(len(ranges)):
+        chunk = await nextChunk
+        if i + 1 < len(ranges):
+            nextChunk = onReader(readChunk, tableName, *ranges[i + 1])
+        await session.connection.sendChunk(chunk)
+    await session.connection.sendChunk(b"")
+
+
+# Function that returns the chunk holding the rows of the designed table between the two designed ids
+def readChunk(tableName, firstId, lastId):
+    return encodeChunk(database.getRawObjectsInRange(tableName, firstId, lastId))
+
+
+# Function that sends the node the changes of the UTXO and Unconfirmed_Transactions tables it didn't apply yet
+# The node sends the epoch and the sequence number of the last change it applied, if the change log still holds
+# every change after it only those are sent, otherwise the node synchronizes the whole tables
+async def syncChanges(session):
+    state = await session.connection.receiveObject()
+    if state is None:
+        return False
+    epoch, firstSeq, lastSeq = await onReader(database.getChangeLogState)
+    nodeEpoch, nodeSeq = state
+    if nodeEpoch == epoch and firstSeq - 1 <= nodeSeq <= lastSeq:
+        changes = await onReader(database.getChanges, nodeSeq, lastSeq)
+        await session.connection.sendObject(("delta", epoch, lastSeq, changes))
+        return True
+    # The tables are read after lastSeq, the changes made in between are sent again next time
+    await session.connection.sendObject(("full", epoch, lastSeq))
+    for tableName in ["Unconfirmed_Transactions", "UTXO"]:
+        if not await syncIds(session, tableName):
+            return False
+    return True
 
-            length = int(nodeSocket.recv(minBufferSize))
-            set2 = pickle.loads(nodeSocket.recv(length))
 
-            # Elements that are missing
-            toAdd = pickle.loads(set1) - set2
+# For the other tables we need to check what indexes are present in the node's and server's database
+# Then we compare the two resulting sets of indexes to see which objects are to be added/deleted
+async def syncIds(session, tableName):
+    set1 = set(await onReader(database.getObjectIdList, tableName))
+    await session.connection.sendObject(set1)
 
-            # Sending the elements that needs to be added
-            for elmnt in toAdd:
-                object = pickle.dumps(database.getObjectById(tableName, elmnt[0]))
-                length = toMinSize(str(len(object))).encode()
-                nodeSocket.send(length)
-                nodeSocket.send(object)
+    set2 = await session.connection.receiveObject()
+    if set2 is None:
+        return False
 
+    # Elements that are missing
+    toAdd = set1 - set2
+
+    # Sending the elements that needs to be added
+    for elmnt in toAdd:
+        await session.connection.sendObject(await onReader(database.getObjectById, tableName, elmnt[0]))
+    return True
 
-def mine():
-    # Sending info about the Genesis Block
-    if database.emptyTable("Blocks"):
-        block = Block(0, [], time.time(), "", "", 50, 0, 2)
-        block.finalReward()
-        length = toMinSize(str(len(pickle.dumps(block))))
-        nodeSocket.send(length.encode())
-        nodeSocket.send(pickle.dumps(block))
-    else:
-        # Sending info about the next Block
-        if not database.emptyTable("Unconfirmed_Transactions"):
-            tx = database.getFirstObject("Unconfirmed_Transactions")
-            index = database.getLastObjectId("Blocks") + 1
-            prevHash = database.getObjectById("Blocks", index - 1).hash
-            block = Block(index,
-                          [Transaction(tx.id, tx.type, tx.inputs, tx.outputs, tx.timestamp,
-                                       tx.transactionId, tx.fees)], time.time(), prevHash, "0", 50, 0, 2)
-            block.finalReward()
-            length = toMinSize(str(len(pickle.dumps(block))))
-            nodeSocket.send(length.encode())
-            nodeSocket.send(pickle.dumps(block))
-        else:
-            # No Block available for mining
-            msg = "0"
-            nodeSocket.send(toMinSize(msg).encode())
-            return False
+
+async def mine(session):
+    # Sending the template of the next Block, the same serialized template is sent to every node until it changes
+    template = await onDatabase(templateCache.get)
+    if template is None:
+        # No Block available for mining, an empty template is sent
+        await session.connection.sendBytes(b"")
+        return False
+    await session.connection.sendBytes(template)
 
     # Waiting to see if the node wants to mine the block
-    request = receive(minBufferSize, "Int")
+    request = await session.connection.receiveInt()
     # Receiving the block's hash then adding the Block to the database
     if request == 1:
-        length = receive(minBufferSize, "Int")
-        block = receive(length, "Object")
-        database.addObject(block)
-        nodeSocket.send(toMinSize("100").encode())
-        # Adding the transactions that are in the block to the database
-        for tx in block.transactions:
-            database.addObject(tx)
-            # If the transaction type is 2 it means that's a regular transaction from node to node
-            # We remove it from the Unconfirmed_Transactions table and add the outputs that are in the tx
-            if tx.type == 2:
-                database.removeObject(database.getFirstObject("Unconfirmed_Transactions"))
-                for output in tx.outputs:
-                    database.addObject(output)
-            # If the transaction type is 1 it means that's a transaction made to reward the miner for mining the block
-            # Then w add the outputs that are in the tx
-            elif tx.type == 1:
-                for output in tx.outputs:
-                    database.addObject(output)
+        return await submitBlock(session)
+    return False
+
+
+# Function that hands the node a nonce range of the current pool template (pool mode)
+# The node sends the public key it's paid to, then answers with the mined block if it found a valid hash in its
+# range or with a report of the exhausted range otherwise
+async def pool(session):
+    pubkey = await session.connection.receiveBytes()
+    if pubkey is None:
+        return False
+    template, generation, start, end = await onDatabase(assignRange, session, bytes(pubkey))
+    if template is None:
+        # No Block available for mining or the public key was refused, an empty template is sent
+        await session.connection.sendBytes(b"")
+        return False
+    await session.connection.sendBytes(template)
+    await session.connection.sendString("{}:{}".format(start, end))
+
+    request = await session.connection.receiveInt()
+    if request == 1:
+        return await submitBlock(session)
+    elif request == 2:
+        # The range was exhausted, the node is told whether its template is still the one being mined
+        # If another node already solved it or the pool changed, the node is cancelled and asks for a new template
+        if await onDatabase(reportRange, generation, session):
+            await session.connection.sendInt(200)
+        else:
+            await session.connection.sendInt(300)
+    return False
+
+
+# Function that returns the current pool template with the next nonce range of it for the designed session
+def assignRange(session, pubkey):
+    if not noncePool.join(session, pubkey):
+        return None, None, None, None
+    templateCache.get()
+    if templateCache.block is None:
+        return None, None, None, None
+    template, generation, (start, end) = noncePool.assign(templateCache.key, templateCache.block, session)
+    return template, generation, start, end
+
+
+# Function that records the exhausted range of the designed session
+# Returns True if the range belongs to the pool template of the template that is still being mined
+def reportRange(generation, session):
+    templateCache.get()
+    return noncePool.report(generation, session) and noncePool.key == templateCache.key
+
+
+# Function that receives a mined block then adds it to the database if it's valid
+async def submitBlock(session):
+    block = await session.connection.receiveObject()
+    if not await onDatabase(acceptSubmittedBlock, block):
+        await session.connection.sendInt(0)
+        return False
+    await session.connection.sendInt(100)
+    return True
+
+
+# Function that adds the designed block to the chain if it's valid
+def acceptSubmittedBlock(block):
+    block = validBlock(block)
+    if block is None:
+        return False
+    # Adding the block, moving its transactions to the Transactions table and adding their outputs in one step
+    database.acceptBlock(block)
+    for tx in block.transactions:
+        mempool.discard(tx.transactionId)
+    if block.id % snapshotInterval == 0:
+        utxoSet.saveSnapshot(background=True)
+        database.trimChangeLog(maxChangeLogSize)
+    return True
+
+
+# Function that checks if a mined block can be added to the chain, returns the block to add or None
+# The block must be a template served by the server: same header fields and the same pending transactions in the
+# same order, followed by the transaction rewarding the miner
+# The ids of the transactions don't cover their outputs, so the block that is added holds the mempool's own
+# transactions and only the coinbase, the nonce and the hash of the mined block
+def validBlock(block):
+    if block is None or not block.transactions:
+        return None
+    template = templateCache.find(block)
+    if template is None:
+        return None
+    # Checking that the block extends the current chain tip with the difficulty and reward it was given
+    if (block.previousHash, block.difficulty, block.reward) != (template.previousHash, template.difficulty,
+                                                                 template.reward):
+        return None
+    if block.previousHash != chainTip():
+        return None
+    if [tx.transactionId for tx in block.transactions[:-1]] != [tx.transactionId for tx in template.transactions]:
+        return None
+    coinbase = block.transactions[-1]
+    if not validCoinbase(coinbase, template.reward):
+        return None
+    # Checking that the Merkle root commits to the block's transactions and that the hash satisfies the difficulty
+    if not block.verify():
+        return None
+    # Checking that the block only confirms pending transactions and that their signatures are valid
+    # The signatures were checked when the transactions entered the mempool so they are found in the cache
+    pending = [mempool.txs.get(tx.transactionId) for tx in template.transactions]
+    if not all(pending) or not all(all(results) for results in verifier.verifyBatch(pending)):
+        return None
+    return Block(template.id, [confirmedCopy(tx) for tx in pending] + [coinbase], template.timestamp,
+                 template.previousHash, block.hash, template.reward, block.nonce, template.difficulty,
+                 block.merkleRoot)
+
+
+# Function that checks that the designed transaction rewards the miner with exactly the designed reward
+def validCoinbase(tx, reward):
+    if tx.type != 1 or tx.inputs or tx.transactionId != tx.hashTxId():
+        return False
+    if not all(output.transactionId == tx.transactionId and output.value >= 0 for output in tx.outputs):
+        return False
+    return math.isclose(sum(output.value for output in tx.outputs), reward, abs_tol=1e-9)
+
+
+# Function that returns the hash of the last block, an empty string if there is no block yet
+def chainTip():
+    lastId = database.getLastObjectId("Blocks")
+    if lastId == 0:
+        return ""
+    return database.getObjectById("Blocks", lastId).hash
 
 
 # Function that is always listening to the node and acts depending on the request made
-def waiting():
-    request = receive(minBufferSize, "Int")
-    if request is not None:
+# The requests are handled one after the other until the node asks to leave or disconnects
+async def waiting(session):
+    while True:
+        request = await session.connection.receiveInt()
         if request == 1:
-            mine()
-            waiting()
+            await mine(session)
         elif request == 2:
-            transaction()
-            waiting()
+            await transaction(session)
+        elif request == 4:
+            await pool(session)
+        elif request == 5 and session.connection.version >= 2:
+            await subscribe(session)
+            return
         else:
-            close()
-
+            return
+
+
+# Function that turns the connection of the node into a push channel, no request is received on it anymore
+# The node is subscribed before it synchronizes again so that nothing committed in between is missed, the pushes
+# it already received with the synchronization are skipped by the node
+async def subscribe(session):
+    queue = publisher.subscribe()
+    try:
+        if not await updateDatabase(session):
+            return
+        while True:
+            payload = await queue.get()
+            if payload is None:
+                return
+            await session.connection.sendPush(payload)
+    finally:
+        publisher.unsubscribe(queue)
+
+
+async def transaction(session):
+    # Receive Transaction from Node
+    tx = await session.connection.receiveObject()
+    if tx is None:
+        return False
+    if await onDatabase(acceptTransaction, tx):
+        await session.connection.sendInt(100)
+        return True
+    await session.connection.sendInt(0)
+    return False
+
+
+# Function that adds the designed transaction to the mempool if it's valid
+def acceptTransaction(tx):
+    # Checking if the Transaction is valid: its id must match its content, its inputs must be unspent,
+    # not spent by another pending transaction and signed by the owner of the locking script
+    valid = isinstance(tx, Transaction) and tx.hashTxId() == tx.transactionId and not mempool.conflicts(tx)
+    utxos = None
+    if valid:
+        utxos = spentUtxos(tx)
+        # The signatures of all the inputs are checked in parallel
+        valid = utxos is not None and validAmounts(tx, utxos) and all(verifier.verify(tx.inputs))
 
-# Function that transform any given string which length is < to the minimum buffer size to the minimum size
-def toMinSize(string):
-    while len(string) < minBufferSize:
-        string += " "
-    return string
+    # If the tx is valid we spend its UTXOS, add it to the mempool and signal the node to do so
+    if valid:
+        with database.unitOfWork():
+            database.removeObjects(utxos)
+            valid = mempool.add(tx, utxos)
+    return valid
 
 
-def transaction():
-    # Receive Transaction from Node
-    length = receive(minBufferSize, "Int")
-    tx = receive(length, "Object")
-    # Checking if the Transaction is valid
-    valid = True
+# Function that returns the utxos spent by the designed transaction, None if an input doesn't spend a utxo,
+# spends one twice or doesn't carry the value and the address of the utxo it spends
+def spentUtxos(tx):
+    utxos = {}
     for input in tx.inputs:
-        if database.getUtxoByScript(input.lockingScript):
-            lockingScript = input.lockingScript
-            scriptSig = input.scriptSig
-            data = lockingScript.split(SEPERATOR.encode())
-            pubkey = VerifyingKey.from_string(data[0], curve=SECP256k1)
-
-            pubkey.verify(scriptSig, lockingScript)
-            database.removeObject(database.getUtxoByScript(input.lockingScript))
-        else:
-            valid = False
+        utxo = utxoSet.find(input.prevTxId, input.lockingScript)
+        if utxo is None or float(input.value) != float(utxo.value) or input.address != utxo.address:
+            return None
+        utxos[outpoint(input.prevTxId, input.lockingScript)] = utxo
+    if len(utxos) != len(tx.inputs):
+        return None
+    return list(utxos.values())
+
+
+# Function that checks that the designed transaction doesn't pay more than the designed utxos it spends and that
+# its fees are the ones of these utxos, the fees order the mempool and are paid to the miner
+def validAmounts(tx, utxos):
+    values = [float(utxo.value) for utxo in utxos]
+    try:
+        outputs = [float(output.value) for output in tx.outputs]
+        fees = float(tx.fees)
+    except (TypeError, ValueError):
+        return False
+    if any(value < 0 for value in outputs) or sum(outputs) > sum(values) + 1e-9:
+        return False
+    return math.isclose(fees, Transaction.feesFor(values), abs_tol=1e-9)
+
+
+# Function that serves a connected node until it leaves, every node has its own coroutine
+async def handleNode(reader, writer):
+    session = NodeSession(reader, writer)
+    # if below code is executed, that means the sender is connected
+    print(f"[+] {session.peer} is connected.")
+    try:
+        if await nodeLogin(session) and await updateDatabase(session):
+            await waiting(session)
+    except (ConnectionResetError, OSError):
+        pass
+    finally:
+        session.connection.close()
+        print(f"[-] {session.peer} is disconnected.")
+        await onDatabase(noncePool.leave, session)
+
+
+# Function that accepts the node connections and serves them all at once
+async def serve():
+    # The socket is bound to our local ip address on the server port, the backlog is the number of
+    # unaccepted connections that the system will allow before refusing new connections
+    server = await asyncio.start_server(handleNode, serverHost, serverPort, backlog=listenBacklog)
+    # The pushes are handed from the database thread to the event loop serving the subscribers
+    publisher.loop = asyncio.get_running_loop()
+    print(f"[*] Listening as {serverHost}:{serverPort}")
+    async with server:
+        await server.serve_forever()
+
+
+# The server only starts when this file is run: the processes of the signature verification pool import it
+if __name__ == "__main__":
+    # Creates the database if non-existent and upgrades the schema of an existing one
+    init_database.main("database.db")
 
-    # If the tx is valid we add it to the database and signal the node to do so
-    if valid:
-        database.addObject(tx)
-        nodeSocket.send(toMinSize("100").encode())
+    # Connecting to existing database
+    conn = sqlite3.connect('database.db', check_same_thread=False)
 
+    # The cursor allow us to execute SQL commands
+    c = conn.cursor()
 
-# Function that closes the connection to the node
-def close():
-    nodeSocket.close()
+    # Creating a Database instance in WAL mode, the syncs and searches of the nodes are read
+    # from a pool of read-only connections while the blocks are written by this connection
+    database = Database(conn, c, "database.db", readerConnections)
 
+    # Logging the changes of the UTXO and Unconfirmed_Transactions tables for the incremental synchronization
+    database.enableChangeLog()
+    database.trimChangeLog(maxChangeLogSize)
 
-# This function is made to be able to handle errors whilst receiving data from the node
-# For example if we are receiving data and the node disconnects in the process the server won't crash
-def receive(length, type):
-    if type == "Object":
-        try:
-            try:
-                object = pickle.loads(nodeSocket.recv(length))
-            except:
-                return None
-            return object
-        except (ConnectionResetError, OSError):
-            close()
-    if type == "Int":
-        try:
-            try:
-                request = int(nodeSocket.recv(length))
-            except TypeError:
-                return None
-            return request
-        except (ConnectionResetError, OSError, ValueError):
-            close()
-    if type == "String":
-        try:
-            try:
-                request = str(nodeSocket.recv(length).decode().strip())
-            except TypeError:
-                return None
-            return request
-        except (ConnectionResetError, OSError, ValueError):
-            close()
+    # The thread that writes to the database and the threads that read it for the nodes
+    databaseExecutor = ThreadPoolExecutor(max_workers=1)
+    readerExecutor = ThreadPoolExecutor(max_workers=readerConnections)
 
+    # Loading the utxos in memory
+    utxoSet = UtxoSet(database, utxoSnapshotPath)
 
-# Loop that will keep the server going indefinitely and accept node connections
-while True:
-    nodeSocket, address = s.accept()
+    # Loading the pending transactions in memory
+    mempool = Mempool(database, maxMempoolSize)
 
-    # if below code is executed, that means the sender is connected
-    print(f"[+] {address} is connected.")
+    # Cache of the next block's template
+    templateCache = BlockTemplateCache(database, mempool)
+
+    # Nonce ranges handed to the nodes mining in pool mode
+    noncePool = NoncePool(poolRangesPerBlock, minPoolRangeSize)
+
+    # Pushes of the committed changes to the subscribed nodes
+    publisher = Publisher(database, maxPushBacklog)
+
+    # Pool of processes checking the signatures of the transactions
+    # The signatures checked when a transaction enters the mempool are not checked again when it's confirmed
+    verifier = SignatureVerifier(cache=SignatureCache(maxSignatureCacheSize))
 
-    nodeLogin()
-    updateDatabase()
-    waiting()
+    # The server runs until it's stopped, the UTXO set is saved then
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        databaseExecutor.shutdown()
+        readerExecutor.shutdown()
+        utxoSet.saveSnapshot()
+        verifier.close()
+        database.close()
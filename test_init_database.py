@@ -0,0 +1,108 @@
+import copyreg
+import os
+import pickle
+import sqlite3
+import tempfile
+import unittest
+from classes import Block, Codec, Input, ObjectDesc, Output, Transaction
+
+
+# OldObject Class that pickles like the objects of the older versions: a plain __dict__ holding an objectDesc
+class OldObject:
+    def __init__(self, cls, **attribs):
+        self.cls = cls
+        self.attribs = attribs
+
+    def __reduce_ex__(self, protocol):
+        return copyreg._reconstructor, (self.cls, object, None), self.attribs
+
+
+# Function that returns a transaction pickled by the older versions
+def oldTransaction(index, transactionId):
+    input = OldObject(Input, value=10, address="sender", prevTxId="prev", lockingScript=b"pubkey<SEPERATOR>sender",
+                      scriptSig=b"signature")
+    output = OldObject(Output, id=None, value=9.9, address="receiver", transactionId=transactionId,
+                       lockingScript=b"pubkey<SEPERATOR>receiver",
+                       objectDesc=ObjectDesc("UTXO", "", {}, "lockingScript", []))
+    return OldObject(Transaction, id=index, type=2, inputs=[input], outputs=[output], timestamp=1.5,
+                     transactionId=transactionId, fees=0.1,
+                     objectDesc=ObjectDesc("Transactions", "", {}, "transactionId", ["inputs", "outputs"]))
+
+
+# Tables as created by the older versions
+oldTables = [
+    "CREATE TABLE Blocks (id integer PRIMARY KEY, transactions text NOT NULL, timestamp integer NOT NULL, "
+    "previousHash text NOT NULL, hash text NOT NULL, reward integer NOT NULL, nonce integer NOT NULL, "
+    "difficulty integer NOT NULL)",
+    "CREATE TABLE Transactions (id integer PRIMARY KEY, type integer NOT NULL, inputs text NOT NULL, "
+    "outputs text NOT NULL, timestamp text NOT NULL, transactionId text NOT NULL, fees integer NOT NULL)",
+    "CREATE TABLE Unconfirmed_Transactions (id integer PRIMARY KEY, type integer NOT NULL, inputs text NOT NULL, "
+    "outputs text NOT NULL, timestamp text NOT NULL, transactionId text NOT NULL, fees integer NOT NULL)",
+    "CREATE TABLE UTXO (id integer PRIMARY KEY, value integer NOT NULL, address text NOT NULL, "
+    "transactionId text NOT NULL, lockingScript text NOT NULL)",
+]
+
+
+class MigrationTest(unittest.TestCase):
+    def setUp(self):
+        # init_database creates a database in the working directory when it's imported
+        self.directory = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.directory.name)
+        import init_database
+        self.init_database = init_database
+        self.conn = sqlite3.connect(os.path.join(self.directory.name, "old.db"))
+        for sql in oldTables:
+            self.conn.execute(sql)
+        tx = oldTransaction(1, "tx1")
+        self.conn.execute("INSERT INTO Blocks VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                          (1, pickle.dumps([tx]), 1, "", "hash", 50, 0, 2))
+        self.conn.execute("INSERT INTO Transactions VALUES (?, ?, ?, ?, ?, ?, ?)",
+                          (1, 2, pickle.dumps(tx.attribs["inputs"]), pickle.dumps(tx.attribs["outputs"]), 1.5,
+                           "tx1", 0.1))
+        # Rows synced by older clients were pickled twice
+        pending = oldTransaction(1, "tx2")
+        self.conn.execute("INSERT INTO Unconfirmed_Transactions VALUES (?, ?, ?, ?, ?, ?, ?)",
+                          (1, 2, pickle.dumps(pickle.dumps(pending.attribs["inputs"])),
+                           pickle.dumps(pickle.dumps(pending.attribs["outputs"])), 1.5, "tx2", 0.1))
+        self.conn.commit()
+
+    def tearDown(self):
+        self.conn.close()
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    def testOldObjectsAreUnpickled(self):
+        block = pickle.loads(pickle.dumps(OldObject(Block, id=1, transactions=[oldTransaction(1, "tx1")],
+                                                    timestamp=1, previousHash="", hash="hash", reward=50, nonce=0,
+                                                    difficulty=2,
+                                                    objectDesc=ObjectDesc("Blocks", "", {}, "id", ["transactions"]))))
+        self.assertEqual(block.merkleRoot, "")
+        self.assertEqual(block.transactions[0].inputs[0].address, "sender")
+        self.assertIsNone(block.transactions[0].cachedTxId)
+
+    def testMigrationRecodesOldRows(self):
+        self.assertEqual(self.init_database.migrate(self.conn), len(self.init_database.migrations))
+        transactions = Codec.decode(self.conn.execute("SELECT transactions FROM Blocks").fetchone()[0])
+        self.assertEqual(transactions[0].transactionId, "tx1")
+        self.assertEqual(transactions[0].outputs[0].value, 9.9)
+        for table, transactionId in [("Transactions", "tx1"), ("Unconfirmed_Transactions", "tx2")]:
+            inputs, outputs = self.conn.execute("SELECT inputs, outputs FROM {}".format(table)).fetchone()
+            self.assertTrue(Codec.isEncoded(inputs))
+            self.assertEqual(Codec.decode(inputs)[0].prevTxId, "prev")
+            self.assertEqual(Codec.decode(outputs)[0].transactionId, transactionId)
+        self.assertEqual(self.conn.execute("SELECT count(*) FROM Tx_Inputs").fetchone()[0], 2)
+
+    def testFailedMigrationIsRolledBack(self):
+        # A pickle of a class that doesn't exist fails with an AttributeError
+        self.conn.execute("UPDATE Transactions SET inputs = ?", (b"cclasses\nMissing\n.",))
+        self.conn.commit()
+        self.assertIsNone(self.init_database.migrate(self.conn))
+        self.assertEqual(self.init_database.get_schema_version(self.conn), 1)
+        self.assertFalse(self.conn.in_transaction)
+        with self.assertRaises(RuntimeError):
+            self.init_database.require_migration(self.conn)
+
+
+if __name__ == "__main__":
+    unittest.main()
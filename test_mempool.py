@@ -0,0 +1,101 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from ecdsa import SECP256k1, SigningKey
+from classes import Database, Input, Output, SignatureVerifier, Transaction, UnconfirmedTransaction, UtxoSet, \
+    createLockingScript
+
+
+class MempoolTest(unittest.TestCase):
+    def setUp(self):
+        # init_database creates a database in the working directory when it's imported
+        self.directory = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.directory.name)
+        import init_database
+        import server
+        self.server = server
+        init_database.main("test.db")
+        self.conn = sqlite3.connect("test.db")
+        self.database = Database(self.conn, self.conn.cursor())
+        self.key = SigningKey.generate(curve=SECP256k1)
+        self.pubkey = self.key.get_verifying_key().to_string()
+
+        # A confirmed transaction paying 50 coins to the address, its output is the only utxo
+        coinbase = Transaction(None, 1)
+        coinbase.computeTxId()
+        self.utxo = createLockingScript(self.pubkey, Output(None, 50, "address", coinbase.transactionId, None))
+        coinbase.addOutput(self.utxo)
+        coinbase.calculateFees()
+        with self.database.unitOfWork():
+            self.database.addObject(coinbase)
+            self.database.addObject(self.utxo)
+        self.row = self.database.getRawObjectById("UTXO", self.utxo.id)
+
+        server.database = self.database
+        server.utxoSet = UtxoSet(self.database)
+        server.mempool = server.Mempool(self.database, 10 ** 6)
+        server.verifier = SignatureVerifier(1)
+
+    def tearDown(self):
+        self.conn.close()
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    # Function that returns a transaction spending the utxo whose input declares the designed value
+    def spend(self, value):
+        tx = UnconfirmedTransaction(None, 2)
+        tx.addInput(Input(value, "address", self.utxo.transactionId, self.utxo.lockingScript,
+                          self.key.sign(self.utxo.lockingScript)))
+        tx.computeTxId()
+        tx.addOutput(createLockingScript(self.pubkey, Output(None, 40, "receiver", tx.transactionId, None)))
+        tx.calculateFees()
+        return tx
+
+    def testEvictedTransactionGivesBackItsUtxo(self):
+        self.assertTrue(self.server.acceptTransaction(self.spend(50)))
+        self.assertTrue(self.database.emptyTable("UTXO"))
+        self.server.mempool.maxSize = 0
+        self.server.mempool.evict()
+        self.assertEqual(len(self.server.mempool), 0)
+        self.assertEqual(self.database.getRawObjectById("UTXO", self.utxo.id), self.row)
+        self.assertIsNotNone(self.server.utxoSet.find(self.utxo.transactionId, self.utxo.lockingScript))
+
+    def testForgedInputValueIsRejected(self):
+        self.assertFalse(self.server.acceptTransaction(self.spend(1e9)))
+        self.assertEqual(len(self.server.mempool), 0)
+        self.assertEqual(self.database.getRawObjectById("UTXO", self.utxo.id), self.row)
+
+    def testForgedFeesAreRejected(self):
+        tx = self.spend(50)
+        tx.fees = 1e9
+        self.assertFalse(self.server.acceptTransaction(tx))
+        self.assertEqual(len(self.server.mempool), 0)
+
+    def testOutputsAboveInputsAreRejected(self):
+        tx = self.spend(50)
+        tx.outputs[0].value = 60
+        self.assertFalse(self.server.acceptTransaction(tx))
+        tx.outputs[0].value = -10
+        self.assertFalse(self.server.acceptTransaction(tx))
+
+    def testConfirmedTransactionsLeaveTheHeap(self):
+        mempool = self.server.mempool
+        for i in range(100):
+            tx = self.spend(50)
+            mempool.track(tx, [])
+            mempool.discard(tx.transactionId)
+        self.assertLessEqual(len(mempool.heap), 1)
+        self.assertEqual(mempool.select(10), [])
+
+    def testRestartedMempoolGivesBackTheSpentValue(self):
+        self.assertTrue(self.server.acceptTransaction(self.spend(50)))
+        mempool = self.server.Mempool(self.database, 0)
+        self.assertEqual(len(mempool), 0)
+        utxo = self.server.utxoSet.find(self.utxo.transactionId, self.utxo.lockingScript)
+        self.assertEqual((utxo.value, utxo.address), (50, "address"))
+
+
+if __name__ == "__main__":
+    unittest.main()